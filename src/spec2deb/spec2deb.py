@@ -12,27 +12,40 @@ it might be failing in your case. And yes ... we take patches.
 
 import bz2  # @UnresolvedImport
 import collections
+import concurrent.futures
+import copy
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from functools import partial
 import glob
 import gzip
 import hashlib
 import io
+import itertools
+import json
 import logging
 try:
     import lzma
 except ImportError:
     from backports import lzma
-from optparse import OptionParser
+import mmap
+from optparse import OptionParser, Values
 import os.path
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import string
+import struct
 import tarfile
 import tempfile
+import threading
 import time
 from zipfile import ZipFile
+import zlib
 
 _log = logging.getLogger(__name__)
 urgency = "low"
@@ -68,6 +81,36 @@ _package_importances = ["required", "important",
                         "standard", "optional", "extra"]
 check = True
 strip = True
+parse_cache_dir = None  # e.g. "~/.cache/spec2deb"
+_parse_cache_format = "3"
+rpm_macro_files = []  # e.g. ["/usr/lib/rpm/macros", "/usr/lib/rpm/macros.d/macros.*"]
+_macro_index_format = "2"
+shell_expansion = False  # run the commands of %(...) and %{lua:...}
+shell_timeout = 10.0  # seconds for each command
+shell_budget = 60.0  # seconds for all the commands of a conversion
+shell_workers = 4
+_shell_cache_format = "1"
+package_mapping_files = []  # with "rpm-name deb-name" lines, see PackageMapping
+package_distro = None  # e.g. "ubuntu" for the [ubuntu] mapping overrides
+_package_mapping_format = "2"
+apt_index_dir = "~/.cache/spec2deb"  # unless a --cache-dir is given
+apt_index_buckets = 65536
+_apt_index_format = "1"
+group_mapping_files = []  # with "section group-prefix" lines, see GroupSections
+compresslevel = 9
+write_buffer_size = 1 << 20  # bytes collected before a write to the compressor
+# the gzip header timestamp - for reproducible builds it is not the current time
+gzip_mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+recompress_buffer_size = 1 << 20  # bytes read and decompressed at a time
+recompress_memlimit = 512 << 20  # bytes the xz decoder may use (None: no limit)
+gzip_threads = 1  # compressing the orig.tar.gz (0: one per cpu)
+gzip_block_size = 1 << 22  # bytes per gzip member with gzip_threads
+orig_placement = "auto"  # or one of _placements to put a .tar.gz Source0
+_placements = ["auto", "reflink", "hardlink", "copy_file_range", "copy"]
+_tar_compressions = {".tar.gz": "gz", ".tgz": "gz", ".tar.xz": "xz", ".tar.bz2": "bz2"}
+_FICLONE = 0x40049409  # linux ioctl to share the extents of a file (reflink)
+hash_buffer_size = 1 << 20  # bytes per read when hashing the files of the dsc
+_manifest_format = "1"
 
 source_format = "1.0"  # "2.0" # "3.0 (quilt)" #
 _source_formats = {
@@ -127,6 +170,269 @@ debian_special_macros = """
 %build_alias            $(DEB_BUILD_GNU_TYPE)
 """
 
+
+def scan_macro_table(text):
+    """ the "%name value" definitions of a macros text (in order) """
+    definition = re.compile(r"\s*[%](\w+)\s+(.*)")
+    table = {}
+    for line in text.split("\n"):
+        found = definition.match(line)
+        if found:
+            name, value = found.groups()
+            table[name] = value.strip()
+    return table
+
+
+# the builtin macro layers are shared by all RpmSpecToDebianControl
+_default_macros = {"autoreqprov": "yes"}
+_default_macros.update(scan_macro_table(usr_lib_rpm_macros))
+_default_typed = dict.fromkeys(_default_macros, "default")
+_default_typed["autoreqprov"] = "global"
+_default_macro_names = [name for name in _default_macros
+                        if _default_typed[name] == "default"]
+_debian_macros = scan_macro_table(debian_special_macros)
+_debian_typed = dict.fromkeys(_debian_macros, "debian")
+
+
+def read_macro_file(filename):
+    """ the definitions of an rpm macros file - like rpm itself the value
+        keeps continuation lines and %{...} bodies spanning multiple lines
+        while the "(opts)" of a parametric macro are dropped """
+    definition = re.compile(r"\s*[%](\w+)(?:[(][^)]*[)])?[ \t]+(.*)", re.DOTALL)
+    leading = re.compile(r"(?:\s|\\\n)*")
+    table = {}
+    lines = []
+    depth = 0
+    with io.open(filename, 'r', encoding='utf8', errors='replace') as f:
+        for line in itertools.chain(f, [""]):
+            line = line.rstrip("\n")
+            if line or lines:
+                lines.append(line)
+            depth = max(0, depth + line.count("{") - line.count("}"))
+            if line and (line.endswith("\\") or depth):
+                continue
+            found = definition.match("\n".join(lines))
+            if found:
+                name, value = found.groups()
+                value = value[leading.match(value).end():]
+                table[name] = value.rstrip()
+            lines = []
+            depth = 0
+    return table
+
+
+class RpmMacroIndex:
+    """ the definitions of rpm macro files where later files override the
+        earlier ones. With a cache_dir the parsed files are kept in a json
+        index that is reused as long as the file mtime and size match. """
+
+    def __init__(self, patterns, cache_dir=None):
+        self.patterns = list(patterns)
+        self.cache_dir = cache_dir
+        self.macros = {}
+        self.typed = {}
+        self.digest = None
+        self.reads = 0
+
+    def files(self):
+        """ the glob patterns may also be colon-separated lists like rpm's
+            macrofiles setting - each pattern is expanded in sorted order """
+        for patterns in self.patterns:
+            for pattern in patterns.split(":"):
+                for filename in sorted(glob.glob(os.path.expanduser(pattern))):
+                    if os.path.isfile(filename):
+                        yield filename
+
+    def index_file(self):
+        key = json.dumps([_macro_index_format, self.patterns])
+        name = "macros-%s.json" % hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(os.path.expanduser(self.cache_dir), name)
+
+    def read_index(self):
+        try:
+            with open(self.index_file(), 'rb') as f:
+                index = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(index, dict) or index.get("format") != _macro_index_format \
+                or not isinstance(index.get("files"), dict):
+            return {}
+        return index["files"]
+
+    def write_index(self, files):
+        index_file = self.index_file()
+        try:
+            if not os.path.isdir(os.path.dirname(index_file)):
+                os.makedirs(os.path.dirname(index_file))
+            tmp_file = "%s.%i.tmp" % (index_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                f.write(json.dumps({"format": _macro_index_format, "files": files},
+                                   separators=(',', ':')).encode('utf-8'))
+            os.replace(tmp_file, index_file)
+        except (IOError, OSError) as e:
+            _log.warning("can not write macro index %s: %s", index_file, e)
+
+    def load(self):
+        index = {}
+        if self.cache_dir:
+            index = self.read_index()
+        files = {}
+        digest = hashlib.sha256(_macro_index_format.encode('utf-8'))
+        for filename in self.files():
+            stat = os.stat(filename)
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            entry = index.get(filename)
+            if not isinstance(entry, list) or len(entry) != 2 or entry[0] != stamp \
+                    or not isinstance(entry[1], dict):
+                _log.debug("reading macro file %s", filename)
+                entry = [stamp, read_macro_file(filename)]
+                self.reads += 1
+            files[filename] = entry
+            self.macros.update(entry[1])
+            digest.update(json.dumps([filename, stamp]).encode('utf-8'))
+        if self.cache_dir and (self.reads or len(files) != len(index)):
+            self.write_index(files)
+        self.typed = dict.fromkeys(self.macros, "macrofile")
+        self.digest = digest.hexdigest()
+        _log.debug("have %i macros from %i files (%i read)",
+                   len(self.macros), len(files), self.reads)
+        return self
+
+
+class RpmShellRunner:
+    """ runs the commands of %(...) and %{lua:...} expansions without stdin
+        in an empty temporary directory with a minimal environment. The
+        output is cached by command and environment (in memory and with a
+        cache_dir also on disk) and commands submitted ahead of time run
+        concurrently in a bounded thread pool. Once the time budget of the
+        conversion is used up no more commands are started. """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.timeout = shell_timeout
+        self.budget = shell_budget
+        self.workers = shell_workers
+        self.env = {"PATH": "/usr/bin:/bin", "LC_ALL": "C"}
+        self.results = {}
+        self.futures = {}
+        self.pool = None
+        self.deadline = None
+        self.runs = 0
+        self.lock = threading.Lock()
+        self.procs = set()
+
+    def key(self, argv):
+        state = [_shell_cache_format, argv, sorted(self.env.items())]
+        return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def cache_file(self, key):
+        return os.path.join(os.path.expanduser(self.cache_dir), "shell-%s.json" % key)
+
+    def remaining(self):
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.budget
+        return self.deadline - time.monotonic()
+
+    def submit(self, argv):
+        """ start the command in the background unless its output is known """
+        key = self.key(argv)
+        if key in self.results or key in self.futures:
+            return key
+        if self.cache_dir:
+            try:
+                with open(self.cache_file(key), 'rb') as f:
+                    self.results[key] = json.loads(f.read().decode('utf-8'))["output"]
+                return key
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.remaining()
+        self.futures[key] = self.pool.submit(self.run, argv)
+        return key
+
+    def output(self, argv):
+        """ the output of the command (None if it failed) """
+        key = self.submit(argv)
+        if key not in self.results:
+            future = self.futures.pop(key)
+            try:
+                output = future.result(max(0, self.remaining()))
+            except concurrent.futures.TimeoutError:
+                _log.error("no time left for command: %s", argv[-1])
+                output = None
+            self.results[key] = output
+            if output is not None and self.cache_dir:
+                self.write_cache(key, output)
+        return self.results[key]
+
+    def write_cache(self, key, output):
+        cache_file = self.cache_file(key)
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            tmp_file = "%s.%i.tmp" % (cache_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                f.write(json.dumps({"output": output}).encode('utf-8'))
+            os.replace(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            _log.warning("can not write shell cache %s: %s", cache_file, e)
+
+    def run(self, argv):
+        timeout = min(self.timeout, self.remaining())
+        if timeout <= 0:
+            _log.error("no time left for command: %s", argv[-1])
+            return None
+        with self.lock:
+            self.runs += 1
+        with tempfile.TemporaryDirectory(prefix="spec2deb-") as cwd:
+            env = dict(self.env, HOME=cwd, TMPDIR=cwd)
+            try:
+                proc = subprocess.Popen(argv, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        start_new_session=True)
+            except OSError as e:
+                _log.error("can not run %s: %s", argv[0], e)
+                return None
+            with self.lock:
+                self.procs.add(proc)
+            try:
+                out, err = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                # kill the whole session as children may keep the pipes open
+                self.kill(proc)
+                proc.communicate()
+                _log.error("timeout after %is for command: %s", timeout, argv[-1])
+                return None
+            finally:
+                with self.lock:
+                    self.procs.discard(proc)
+        if proc.returncode:
+            _log.warning("exit code %s from command: %s\n %s", proc.returncode,
+                         argv[-1], err.decode('utf-8', 'replace').strip())
+        return out.decode('utf-8', 'replace').rstrip("\n")
+
+    def kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass  # gone already
+
+    def close(self):
+        """ drop the commands not started yet and kill the running ones,
+            then wait for the workers to remove their directories """
+        if self.pool is not None:
+            # (the cancel_futures of shutdown needs python 3.9)
+            for future in self.futures.values():
+                future.cancel()
+            self.pool.shutdown(wait=False)
+            with self.lock:
+                for proc in self.procs:
+                    self.kill(proc)
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
 known_package_mapping = {
     "zlib-devel": "zlib1g-dev",
     "sdl-devel": "libsdl-dev",
@@ -145,9 +451,1315 @@ known_package_mapping = {
     "gcc-c++": "g++"
 }
 
+# the "*" part of the rpm name is copied to the debian name (with "::" as "-")
+package_mapping_rules = """
+perl(*)         lib*-perl
+pkgconfig(*)    lib*-dev
+python3dist(*)  python3-*
+rubygem(*)      ruby-*
+*-devel         *-dev
+"""
+
+
+class PackageMapping:
+    """ rpm package names to debian package names. The exact names of
+        known_package_mapping and the rules of package_mapping_rules come
+        first and the mapping files may add more. Each line of a file has
+        an rpm name (or a pattern with one "*") and the debian name, while a
+        "[distro]" header starts the overrides for that package_distro. An
+        exact name is preferred over a pattern, then the longest prefix and
+        the longest suffix, and the later one over the earlier one.
+        With a cache_dir the index is kept as json for the next run as long
+        as the mtime and size of the files are the same. """
+
+    def __init__(self, files=(), distro=None, cache_dir=None):
+        self.files = list(files)
+        self.distro = distro
+        self.cache_dir = cache_dir
+        self.exact = {}
+        self.rules = {}
+        self.memo = {}
+
+    def add(self, name, deb_name):
+        if "*" not in name:
+            self.exact[name] = deb_name
+            return
+        prefix, suffix = name.split("*", 1)
+        rules = [rule for rule in self.rules.get(prefix, []) if rule[0] != suffix]
+        rules.append((suffix, deb_name))
+        rules.sort(key=lambda rule: -len(rule[0]))
+        self.rules[prefix] = rules
+
+    def scan(self, text, filename="<package_mapping_rules>"):
+        section = None
+        for lineno, line in enumerate(text.split("\n"), 1):
+            line = line.split("#", 1)[0].strip()
+            if line.startswith("[") and line.endswith("]"):
+                section = line[1:-1].strip()
+            elif line and section in (None, self.distro):
+                parts = line.split(None, 1)
+                if len(parts) != 2:
+                    _log.warning("%s:%i: no debian name for '%s'", filename, lineno, line)
+                    continue
+                self.add(parts[0], parts[1].strip())
+
+    def index_key(self):
+        stamps = []
+        for filename in self.files:
+            stat = os.stat(filename)
+            stamps.append([filename, stat.st_mtime_ns, stat.st_size])
+        state = [_package_mapping_format, self.distro, stamps,
+                 known_package_mapping, package_mapping_rules]
+        return hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()
+
+    def load(self):
+        index_file = None
+        if self.cache_dir:
+            name = "mapping-%s.json" % self.index_key()
+            index_file = os.path.join(os.path.expanduser(self.cache_dir), name)
+            try:
+                with open(index_file, 'rb') as f:
+                    exact, rules = json.loads(f.read().decode('utf-8'))
+                if isinstance(exact, dict) and isinstance(rules, dict):
+                    self.exact, self.rules = exact, rules
+                    return self
+            except (IOError, OSError, ValueError, TypeError):
+                pass
+        self.exact = dict(known_package_mapping)
+        self.scan(package_mapping_rules)
+        for filename in self.files:
+            with io.open(filename, 'r', encoding='utf8') as f:
+                self.scan(f.read(), filename)
+        if index_file:
+            try:
+                if not os.path.isdir(os.path.dirname(index_file)):
+                    os.makedirs(os.path.dirname(index_file))
+                tmp_file = "%s.%i.tmp" % (index_file, os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    f.write(json.dumps([self.exact, self.rules],
+                                       separators=(',', ':')).encode('utf-8'))
+                os.replace(tmp_file, index_file)
+            except (IOError, OSError) as e:
+                _log.warning("can not write package mapping %s: %s", index_file, e)
+        return self
+
+    def get(self, name):
+        deb_name = self.memo.get(name)
+        if deb_name is None:
+            deb_name = self.memo[name] = self.resolve(name)
+        return deb_name
+
+    def resolve(self, name):
+        if name in self.exact:
+            return self.exact[name]
+        for end in range(len(name), -1, -1):
+            for suffix, deb_name in self.rules.get(name[:end], ()):
+                if name.endswith(suffix) and len(name) - len(suffix) >= end:
+                    part = name[end:len(name) - len(suffix)]
+                    return deb_name.replace("*", part.replace("::", "-"))
+        return name
+
+
+def open_compressed(filename):
+    """ a text stream of a file that may be compressed (by its extension) """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'rt', encoding='utf8', errors='replace')
+    if filename.endswith(".xz"):
+        return lzma.open(filename, 'rt', encoding='utf8', errors='replace')
+    if filename.endswith(".bz2"):
+        return bz2.open(filename, 'rt', encoding='utf8', errors='replace')
+    return io.open(filename, 'r', encoding='utf8', errors='replace')
+
+
+class AptIndex:
+    """ debian package names by package name (p:), by provided name (v:),
+        by file path (f:) and by library soname (s:) from the apt Packages
+        and Contents-<arch> files. The records are streamed into a file of
+        hash buckets, sorted by key within each bucket, which is memory
+        mapped for the lookups - neither building nor using the index
+        needs the Contents in memory. The index file is reused as long as
+        the mtime and size of the apt files are the same, and the index of
+        older apt files is removed when a new one is built. """
+    magic = b"spec2deb-apt-index\n"
+    on_soname = re.compile(r"/(lib[^/]*[.]so(?:[.]\d+)*)$")
+    on_soname_require = re.compile(r"(lib[^/()\s]*[.]so[^/()\s]*)[(]")
+
+    def __init__(self, packages_files=(), contents_files=(), index_dir=apt_index_dir):
+        self.packages_files = list(packages_files)
+        self.contents_files = list(contents_files)
+        self.index_dir = index_dir
+        self.data = None
+        self.buckets = 0
+        self.memo = {}
+
+    def index_prefix(self):
+        """ the index files of the same apt files start with the same name """
+        sources = [os.path.abspath(filename)
+                   for filename in self.packages_files + self.contents_files]
+        return "apt-%s-" % hashlib.sha256(json.dumps(sources).encode('utf-8')).hexdigest()[:32]
+
+    def index_file(self):
+        stamps = []
+        for filename in self.packages_files + self.contents_files:
+            stat = os.stat(filename)
+            stamps.append([os.path.abspath(filename), stat.st_mtime_ns, stat.st_size])
+        state = [_apt_index_format, apt_index_buckets, stamps]
+        name = "%s%s.index" % (self.index_prefix(),
+                               hashlib.sha256(json.dumps(state).encode('utf-8')).hexdigest()[:32])
+        return os.path.join(os.path.expanduser(self.index_dir), name)
+
+    def prune(self, index_file):
+        """ remove the index files of older versions of the same apt files """
+        index_dir, name = os.path.split(index_file)
+        prefix = self.index_prefix()
+        for other in os.listdir(index_dir):
+            if other.startswith(prefix) and other.endswith(".index") and other != name:
+                try:
+                    os.remove(os.path.join(index_dir, other))
+                except OSError as e:
+                    _log.warning("can not remove old apt index %s: %s", other, e)
+
+    def open(self):
+        index_file = self.index_file()
+        if not os.path.exists(index_file):
+            self.build(index_file)
+            self.prune(index_file)
+        with open(index_file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(self.magic)] != self.magic:
+            raise ValueError("not an apt index: " + index_file)
+        self.buckets, = struct.unpack_from("<I", self.data, len(self.magic))
+        return self
+
+    def records(self):
+        for filename in self.packages_files:
+            _log.debug("indexing %s", filename)
+            with open_compressed(filename) as f:
+                name = None
+                for line in f:
+                    if line.startswith("Package:"):
+                        name = line[8:].strip()
+                    elif line.startswith("Version:") and name:
+                        yield "p:" + name, line[8:].strip()
+                    elif line.startswith("Provides:") and name:
+                        for provided in line[9:].split(","):
+                            yield "v:" + provided.split("(")[0].strip(), name
+        for filename in self.contents_files:
+            _log.debug("indexing %s", filename)
+            with open_compressed(filename) as f:
+                for line in f:
+                    parts = line.rstrip("\n").rsplit(None, 1)
+                    if len(parts) != 2:
+                        continue
+                    path, locations = parts
+                    packages = ",".join(location.rsplit("/", 1)[-1]
+                                        for location in locations.split(","))
+                    yield "f:" + path, packages
+                    found = self.on_soname.search(path)
+                    if found and "lib" in path[:found.start()]:
+                        yield "s:" + found.group(1), packages
+
+    def build(self, index_file, parts=256):
+        """ the records are spread over temporary part files (each holding a
+            range of buckets) so that only one part is sorted in memory """
+        index_dir = os.path.dirname(index_file)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        buckets = apt_index_buckets
+        tmp_dir = tempfile.mkdtemp(prefix="spec2deb-", dir=index_dir)
+        try:
+            part_files = [open(os.path.join(tmp_dir, str(n)), 'wb') for n in range(parts)]
+            try:
+                for key, value in self.records():
+                    key = key.encode('utf-8')
+                    bucket = zlib.crc32(key) % buckets
+                    part_files[bucket * parts // buckets].write(
+                        key + b"\0" + value.encode('utf-8') + b"\n")
+            finally:
+                for f in part_files:
+                    f.close()
+            offsets = [0] * (buckets + 1)
+            header = len(self.magic) + 4 + 8 * (buckets + 1)
+            tmp_file = os.path.join(tmp_dir, "index")
+            with open(tmp_file, 'wb') as out:
+                out.write(b"\0" * header)
+                offset = header
+                for n in range(parts):
+                    with open(os.path.join(tmp_dir, str(n)), 'rb') as f:
+                        records = []
+                        for record in f:
+                            key, value = record.rstrip(b"\n").split(b"\0", 1)
+                            records.append((zlib.crc32(key) % buckets, key, value))
+                    records.sort()
+                    for (bucket, key), same in itertools.groupby(
+                            records, lambda record: record[:2]):
+                        values = []
+                        for _, _, value in same:
+                            if value not in values:
+                                values.append(value)
+                        record = key + b"\0" + b",".join(values) + b"\n"
+                        out.write(record)
+                        offsets[bucket + 1] = offset = offset + len(record)
+                # empty buckets end where the previous one ends
+                offsets[0] = header
+                for bucket in range(1, buckets + 1):
+                    offsets[bucket] = max(offsets[bucket], offsets[bucket - 1])
+                out.seek(0)
+                out.write(self.magic + struct.pack("<I", buckets))
+                out.write(struct.pack("<%iQ" % (buckets + 1), *offsets))
+            os.replace(tmp_file, index_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def get(self, key):
+        """ the value of the key in the index (or None) """
+        data = self.data
+        key = key.encode('utf-8')
+        bucket = zlib.crc32(key) % self.buckets
+        lo, hi = struct.unpack_from("<2Q", data, len(self.magic) + 4 + 8 * bucket)
+        while lo < hi:
+            start = max(lo, data.rfind(b"\n", lo, (lo + hi) // 2) + 1)
+            end = data.find(b"\n", start, hi)
+            other, value = data[start:end].split(b"\0", 1)
+            if other == key:
+                return value.decode('utf-8')
+            if other < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def has_package(self, name):
+        return self.get("p:" + name) is not None or self.get("v:" + name) is not None
+
+    def resolve(self, require):
+        """ the debian package providing a file or a library soname (e.g.
+            "/usr/bin/perl" or "libfoo.so.1()(64bit)") - or None """
+        if require not in self.memo:
+            value = None
+            if require.startswith("/"):
+                path = require.lstrip("/")
+                value = self.get("f:" + path)
+                if value is None:
+                    # merged /usr
+                    if path.startswith("usr/"):
+                        value = self.get("f:" + path[4:])
+                    else:
+                        value = self.get("f:usr/" + path)
+            else:
+                found = self.on_soname_require.match(require)
+                if found:
+                    value = self.get("s:" + found.group(1))
+            self.memo[require] = value.split(",")[0] if value else None
+        return self.memo[require]
+
+
+class RpmRelation(collections.namedtuple("RpmRelation", ["name", "operator", "version"])):
+    """ a parsed rpm dependency like "foo >= 1.0" - see parse() """
+    __slots__ = ()
+    on_relation = re.compile(r"(\S+)\s+(=>|>=|>|<|=<|<=|=|==)\s+(\S+)")
+    deb_operators = {"<": "<<", ">": ">>", "=>": ">=", "=<": "<=", "==": "=",
+                     "<=": "<=", ">=": ">=", "=": "="}
+    _interned = {}
+
+    @classmethod
+    def parse(cls, text):
+        """ the same object for the same text (without an operator the
+            name is the whole text) """
+        relation = cls._interned.get(text)
+        if relation is None:
+            found = cls.on_relation.match(text)
+            if found:
+                relation = cls(*found.groups())
+            else:
+                relation = cls(text.strip(), None, None)
+            cls._interned[text] = relation
+        return relation
+
+    def deb_operator(self):
+        return self.deb_operators[self.operator]
+
+
+# there are 3 areas ("main", "contrib", "non-free") with multiple
+# sections. http://packages.debian.org/unstable/ has a list of all
+# sections that are currently used. - For Opensuse the current group
+# list is at http://en.opensuse.org/openSUSE:Package_group_guidelines
+group_sections = {
+    "admin": [],
+    "cli-mono": [],
+    "comm": [],
+    "database": ["Productivity/Database"],
+    "debian-installer": [],
+    "debug": ["Development/Tools/Debuggers"],
+    "devel": ["Development/Languages/C and C++"],
+    "doc": ["Documentation"],
+    "editors": [],
+    "electronics": [],
+    "embedded": [],
+    "fonts": [],
+    "games": ["Amusements/Game"],
+    "gnome": ["System/GUI/GNOME"],
+    "gnu-r": [],
+    "gnustep": ["System/GUI/Other"],
+    "graphics": ["Productivity/Graphics"],
+    "hamradio": ["Productivity/Hamradio"],
+    "haskell": [],
+    "httpd": ["Productivity/Networking/Web"],
+    "interpreters": ["Development/Languages/Other"],
+    "java": ["Development/Languages/Java"],
+    "kde": ["System/GUI/KDE"],
+    "kernel": ["System/Kernel"],
+    "libdevel": ["Development/Tool"],
+    "libs": ["Development/Lib", "System/Lib"],
+    "lisp": [],
+    "localization": ["System/Localization", "System/i18n"],
+    "mail": ["Productivity/Networking/Email"],
+    "math": ["Amusements/Teaching/Math", "Productivity/Scientific/Math"],
+    "misc": [],
+    "net": ["Productivity/Networking/System"],
+    "news": ["Productivity/Networking/News"],
+    "ocaml": [],
+    "oldlibs": [],
+    "othersofs": [],
+    "perl": ["Development/Languages/Perl"],
+    "php": [],
+    "python": ["Development/Languages/Python"],
+    "ruby": ["Development/Languages/Ruby"],
+    "science": ["Productivity/Scientific"],
+    "shells": ["System/Shell"],
+    "sound": ["System/Sound"],
+    "tex": ["Productivity/Publishing/TeX"],
+    "text": ["Productivity/Publishing"],
+    "utils": [],
+    "vcs": ["Development/Tools/Version Control"],
+    "video": [],
+    "virtual": [],
+    "web": [],
+    "x11": ["System/X11"],
+    "xfce": ["System/GUI/XFCE"],
+    "zope": [],
+}
+
+
+class GroupSections:
+    """ debian sections of rpm groups by the longest matching group prefix
+        of group_sections and of the mapping files where each line has a
+        section and a group prefix (e.g. "utils Applications/System") """
+
+    def __init__(self, files=()):
+        self.files = list(files)
+        self.prefixes = {}
+        self.memo = {}
+        for section, group_prefixes in group_sections.items():
+            for group_prefix in group_prefixes:
+                self.prefixes.setdefault(group_prefix, section)
+        for filename in files:
+            with io.open(filename, 'r', encoding='utf8') as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        parts = line.split(None, 1)
+                        if len(parts) != 2:
+                            _log.warning("%s:%i: no group prefix for '%s'",
+                                         filename, lineno, line)
+                            continue
+                        self.prefixes[parts[1].strip()] = parts[0]
+        self.longest = max([len(group_prefix) for group_prefix in self.prefixes] or [0])
+
+    def section(self, group):
+        section = self.memo.get(group)
+        if section is None:
+            section = self.memo[group] = self.lookup(group)
+        return section
+
+    def lookup(self, group):
+        for end in range(min(len(group), self.longest), 0, -1):
+            section = self.prefixes.get(group[:end])
+            if section:
+                return section
+        # make a guess:
+        if "Lib" in group:
+            return "libs"
+        elif "Network" in group:
+            return "net"
+        else:
+            return "utils"
+
+
+_group_sections = None
+
+
+def default_group_sections():
+    """ the GroupSections of group_mapping_files shared by the converters """
+    global _group_sections
+    if _group_sections is None:
+        _group_sections = GroupSections(group_mapping_files)
+    return _group_sections
+
+
+def decompressed_chunks(f, decompressor, buffer_size, **options):
+    """ the data of a compressed stream (e.g. with lzma.LZMADecompressor)
+        in chunks of at most buffer_size bytes - concatenated streams are
+        decompressed one after the other like xz and bzip2 do """
+    decoder = decompressor(**options)
+    while True:
+        if decoder.eof:
+            data = decoder.unused_data or f.read(buffer_size)
+            if not data:
+                return
+            decoder = decompressor(**options)
+        elif decoder.needs_input:
+            data = f.read(buffer_size)
+            if not data:
+                raise EOFError("compressed file ended before the end-of-stream marker")
+        else:
+            data = b""
+        chunk = decoder.decompress(data, buffer_size)
+        if chunk:
+            yield chunk
+
+
+def gzip_member(data, compresslevel=9, mtime=0):
+    """ the data as one gzip member, the same bytes as gzip.compress which
+        has no mtime argument before python 3.8 """
+    extra_flags = {9: 2, 1: 4}.get(compresslevel, 0)
+    header = b"\x1f\x8b\x08\x00" + struct.pack("<IBB", int(mtime), extra_flags, 255)
+    deflate = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+class ParallelGzipWriter:
+    """ a gzip file writer compressing blocks in a thread pool like pigz
+        (zlib releases the GIL). Each block becomes a gzip member of its
+        own - gunzip and dpkg-source read a multi-member gzip as the
+        concatenation of the members. At most two blocks per thread are
+        held in memory. Like GzipFile a given fileobj is not closed. """
+
+    def __init__(self, filename, compresslevel=9, mtime=0, threads=0,
+                 block_size=gzip_block_size, fileobj=None):
+        self.compresslevel = compresslevel
+        self.mtime = mtime
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.offset = 0
+        self.pending = collections.deque()
+        self.fileobj = fileobj
+        # the file first: a failing open leaves no pool behind
+        self.f = open(filename, "wb") if fileobj is None else fileobj
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(
+            gzip_member, block, self.compresslevel, self.mtime))
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer or not self.offset:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            if self.fileobj is None:
+                self.f.close()
+
+
+FileDigests = collections.namedtuple("FileDigests", ["size", "md5", "sha1", "sha256"])
+_missing_digests = FileDigests(0, "0" * 32, "0" * 40, "0" * 64)
+
+
+class DigestWriter:
+    """ a binary output file that computes the FileDigests of the bytes
+        as they are written, so the dsc needs not read the file again.
+        The bytes go to a temporary file which replaces the filename on a
+        clean close - an existing file (that may be a hardlink of an input)
+        is never written into. The digests go then into the written dict
+        under the absolute filename together with the size and mtime, which
+        tells whether the file was changed afterwards. """
+
+    def __init__(self, filename, written=None):
+        self.filename = filename
+        self.written = written
+        self.digests = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+        self.size = 0
+        self.tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+        self.f = open(self.tmp_file, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(exc_type is None)
+
+    def write(self, data):
+        for digest in self.digests:
+            digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def tell(self):
+        return self.size
+
+    def file_digests(self):
+        return FileDigests(self.size, *[digest.hexdigest() for digest in self.digests])
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+    def discard(self):
+        """ close a file that was not finished - the filename is kept as it was """
+        self.close(False)
+
+    def close(self, finished=True):
+        if self.f.closed:
+            return
+        self.f.close()
+        if not finished:
+            os.remove(self.tmp_file)
+            return
+        os.replace(self.tmp_file, self.filename)
+        if self.written is not None:
+            stat = os.stat(self.filename)
+            self.written[os.path.abspath(self.filename)] = (
+                stat.st_size, stat.st_mtime_ns, self.file_digests())
+
+
+def file_digests(filename, buffer_size=None):
+    """ the size, md5, sha1 and sha256 of a file from one pass over it """
+    digests = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+    buffer = bytearray(buffer_size or hash_buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    with open(filename, "rb", buffering=0) as f:
+        for count in iter(partial(f.readinto, buffer), 0):
+            for digest in digests:
+                digest.update(view[:count])
+            size += count
+    return FileDigests(size, *[digest.hexdigest() for digest in digests])
+
+
+def fingerprint(*parts):
+    """ the sha256 of json-able parts """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(filename, content=True):
+    """ the file with the sha256 of its content - or just its size and
+        mtime for large files like the sources (None when missing) """
+    if not filename or not os.path.isfile(filename):
+        return [filename, None]
+    if not content:
+        stat = os.stat(filename)
+        return [filename, stat.st_size, stat.st_mtime_ns]
+    with open(filename, "rb") as f:
+        return [filename, hashlib.sha256(f.read()).hexdigest()]
+
+
+_tool_fingerprint = None
+
+
+def tool_fingerprint():
+    """ a new spec2deb may generate different files """
+    global _tool_fingerprint
+    if _tool_fingerprint is None:
+        _tool_fingerprint = [_manifest_format, file_fingerprint(__file__)[1]]
+    return _tool_fingerprint
+
+
+class OutputManifest:
+    """ the input fingerprints and digests of the files written by a
+        conversion, kept next to them for an incremental conversion. An
+        output is unchanged when it was written from the same inputs and
+        the file still has the recorded size and mtime. The settings (the
+        commandline options) are part of the inputs of the debian files. """
+
+    def __init__(self, filename, settings=None):
+        self.filename = filename
+        self.settings = settings or {}
+        self.outputs = {}
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                data = json.loads(f.read().decode('utf-8'))
+            if data.get("tool") == tool_fingerprint():
+                self.outputs = data["outputs"]
+        except (IOError, OSError, ValueError, KeyError) as e:
+            _log.debug("no manifest '%s': %s", self.filename, e)
+        return self
+
+    def unchanged(self, name, filepath, inputs):
+        """ the FileDigests of an output written from the same inputs """
+        entry = self.outputs.get(name)
+        if not entry or entry["inputs"] != inputs or not os.path.isfile(filepath):
+            return None
+        stat = os.stat(filepath)
+        if [stat.st_size, stat.st_mtime_ns] != entry["stat"]:
+            return None
+        return FileDigests(*entry["digests"])
+
+    def record(self, name, filepath, inputs, digests):
+        stat = os.stat(filepath)
+        self.outputs[name] = {"inputs": inputs, "stat": [stat.st_size, stat.st_mtime_ns],
+                              "digests": list(digests)}
+
+    def save(self):
+        data = {"tool": tool_fingerprint(), "outputs": self.outputs}
+        tmp_file = "%s.%i.tmp" % (self.filename, os.getpid())
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(json.dumps(data, sort_keys=True, indent=1).encode('utf-8'))
+            os.replace(tmp_file, self.filename)
+        except (IOError, OSError) as e:
+            _log.warning("can not write manifest '%s': %s", self.filename, e)
+
+
+def tar_compression(filename):
+    """ gz, xz or bz2 for a compressed tarball name (else None) """
+    for suffix, compression in _tar_compressions.items():
+        if filename.endswith(suffix):
+            return compression
+    return None
+
+
+def same_content(filename1, filename2, buffer_size=1 << 20):
+    """ the files have the same size and bytes """
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    if os.path.samefile(filename1, filename2):
+        return True
+    with open(filename1, "rb") as f1, open(filename2, "rb") as f2:
+        while True:
+            data1 = f1.read(buffer_size)
+            if data1 != f2.read(buffer_size):
+                return False
+            if not data1:
+                return True
+
+
+def place_file(source, target, placement="auto"):
+    """ put a copy of the source file at the target and return how it was
+        done. Unless the placement is "copy" an identical target is kept
+        as it is. Then "auto" tries a reflink and copy_file_range - while a
+        specific placement is tried on its own, and a hardlink (on the same
+        file system) is only made when asked for since the target is then
+        the source file itself. Whatever fails falls back to a plain copy.
+        The target is written under a temporary name and renamed at the end. """
+    if placement != "copy" and os.path.exists(target) and same_content(source, target):
+        return "identical"
+    if placement == "auto":
+        placements = ["reflink", "copy_file_range"]
+    elif placement == "copy":
+        placements = []
+    else:
+        placements = [placement]
+    tmp_file = "%s.%i.tmp" % (target, os.getpid())
+    for how in placements + ["copy"]:
+        try:
+            if how == "hardlink":
+                if os.stat(source).st_dev != os.stat(os.path.dirname(target) or ".").st_dev:
+                    continue
+                os.link(source, tmp_file)
+            elif how == "copy":
+                shutil.copyfile(source, tmp_file)
+            else:
+                with open(source, "rb") as src, open(tmp_file, "wb") as dst:
+                    if how == "reflink":
+                        if fcntl is None:
+                            raise OSError("no fcntl for a reflink")
+                        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                    elif how == "copy_file_range":
+                        if not hasattr(os, "copy_file_range"):
+                            raise OSError("no os.copy_file_range")
+                        size = os.fstat(src.fileno()).st_size
+                        copied = 0
+                        while copied < size:
+                            done = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                            if not done:
+                                raise OSError("copy_file_range stopped at %i" % copied)
+                            copied += done
+            os.replace(tmp_file, target)
+            return how
+        except (IOError, OSError) as e:
+            _log.debug("no %s of %s: %s", how, source, e)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            if how == "copy":
+                raise
+    return "copy"
+
+
+_package_mapping = None
+
+
+def default_package_mapping():
+    """ the PackageMapping of package_mapping_files shared by the converters """
+    global _package_mapping
+    if _package_mapping is None:
+        _package_mapping = PackageMapping(package_mapping_files, package_distro).load()
+    return _package_mapping
+
+
+def rpmvercmp(a, b):
+    """ compare two version strings the way rpm does: returns -1, 0 or 1.
+        Digit and letter segments are compared separately, a "~" sorts
+        before anything (even the end) and a "^" sorts after the end. """
+    if a == b:
+        return 0
+    one, two = a, b
+    while one or two:
+        one = _vercmp_junk.sub("", one, 1)
+        two = _vercmp_junk.sub("", two, 1)
+        if one.startswith("~") or two.startswith("~"):
+            if not one.startswith("~"):
+                return 1
+            if not two.startswith("~"):
+                return -1
+            one, two = one[1:], two[1:]
+            continue
+        if one.startswith("^") or two.startswith("^"):
+            if not one:
+                return -1
+            if not two:
+                return 1
+            if not one.startswith("^"):
+                return 1
+            if not two.startswith("^"):
+                return -1
+            one, two = one[1:], two[1:]
+            continue
+        if not one or not two:
+            break
+        isnum = one[0].isdigit()
+        segment = _vercmp_digits if isnum else _vercmp_alpha
+        seg1 = segment.match(one).group(0)
+        seg2 = segment.match(two).group(0)
+        one, two = one[len(seg1):], two[len(seg2):]
+        if not seg2:
+            return 1 if isnum else -1
+        if isnum:
+            seg1, seg2 = seg1.lstrip("0"), seg2.lstrip("0")
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+        if seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+    if not one and not two:
+        return 0
+    return 1 if one else -1
+
+
+_vercmp_junk = re.compile(r"[^a-zA-Z0-9~^]*")
+_vercmp_digits = re.compile(r"[0-9]*")
+_vercmp_alpha = re.compile(r"[a-zA-Z]*")
+
+
+def rpmevrcmp(a, b):
+    """ compare "[epoch:]version[-release]" strings, a missing release
+        on either side is not compared (like rpm's v"..." operands) """
+    def split(evr):
+        epoch, _, rest = evr.rpartition(":")
+        version, _, release = rest.partition("-")
+        return int(epoch or 0), version, release
+    epoch1, version1, release1 = split(a)
+    epoch2, version2, release2 = split(b)
+    if epoch1 != epoch2:
+        return 1 if epoch1 > epoch2 else -1
+    result = rpmvercmp(version1, version2)
+    if result or not release1 or not release2:
+        return result
+    return rpmvercmp(release1, release2)
+
+
+RpmVersion = collections.namedtuple("RpmVersion", ["evr"])
+
+
+class RpmExpression:
+    """ Parser and evaluator for the (already expanded) expression of an
+        %if/%elif line, following rpm's expression grammar: integers,
+        "strings", v"versions" (and bare dotted versions like 1.2.3),
+        ! - * / + - < > <= >= == != && || and the ?: operator. Nothing is
+        executed - errors raise ValueError. The parsed expressions are kept
+        in a class-wide cache as the same conditions are found in many specs. """
+
+    on_token = re.compile(r"""\s*(?:
+        (?P<version>\d+(?:[.]\w+)+)
+        |(?P<number>\d+)
+        |v"(?P<vstring>[^"]*)"
+        |"(?P<string>[^"]*)"
+        |'(?P<quoted>[^']*)'
+        |(?P<op>&&|[|][|]|==|!=|<=|>=|[-+*/<>!()?:])
+        |(?P<word>and|or)\b
+        |(?P<error>\S+))""", re.VERBOSE)
+    _compiled = {}
+    _compare = {
+        "==": lambda c: c == 0,
+        "!=": lambda c: c != 0,
+        "<": lambda c: c < 0,
+        ">": lambda c: c > 0,
+        "<=": lambda c: c <= 0,
+        ">=": lambda c: c >= 0,
+    }
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        while True:
+            found = self.on_token.match(text, pos)
+            if not found or found.end() == pos:
+                break
+            pos = found.end()
+            kind = found.lastgroup
+            value = found.group(kind)
+            if kind == "error":
+                raise ValueError("unexpected '%s' in: %s" % (value, text))
+            if kind == "word":
+                kind, value = "op", {"and": "&&", "or": "||"}[value]
+            elif kind == "number":
+                value = int(value)
+            elif kind in ("version", "vstring"):
+                value = RpmVersion(value)
+            elif kind == "quoted":
+                kind = "string"
+            self.tokens.append((kind, value))
+        self.pos = 0
+        self.tree = self.parse_ternary()
+        if self.pos < len(self.tokens):
+            raise ValueError("unexpected '%s' in: %s" % (self.tokens[self.pos][1], text))
+
+    @classmethod
+    def compile(cls, text):
+        tree = cls._compiled.get(text)
+        if tree is None:
+            tree = cls(text).tree
+            cls._compiled[text] = tree
+        return tree
+
+    @classmethod
+    def evaluate(cls, text):
+        return cls.value(cls.compile(text))
+
+    @classmethod
+    def true(cls, text):
+        return cls.truth(cls.evaluate(text))
+
+    # --------------------------------------------------------- parser
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def take(self, *ops):
+        kind, value = self.peek()
+        if kind == "op" and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def parse_ternary(self):
+        tree = self.parse_binary(0)
+        if self.take("?"):
+            then = self.parse_ternary()
+            if not self.take(":"):
+                raise ValueError("missing ':' for '?' in: %s" % self.text)
+            tree = ("?", tree, then, self.parse_ternary())
+        return tree
+
+    _levels = (("||",), ("&&",), ("==", "!=", "<", ">", "<=", ">="),
+               ("+", "-"), ("*", "/"))
+
+    def parse_binary(self, level):
+        if level == len(self._levels):
+            return self.parse_unary()
+        tree = self.parse_binary(level + 1)
+        while True:
+            op = self.take(*self._levels[level])
+            if not op:
+                return tree
+            tree = (op, tree, self.parse_binary(level + 1))
+
+    def parse_unary(self):
+        op = self.take("!", "-")
+        if op:
+            return (op + "x", self.parse_unary())
+        if self.take("("):
+            tree = self.parse_ternary()
+            if not self.take(")"):
+                raise ValueError("missing ')' in: %s" % self.text)
+            return tree
+        kind, value = self.peek()
+        if kind in ("number", "string", "version", "vstring"):
+            self.pos += 1
+            return ("=", value)
+        if kind is None:
+            raise ValueError("unexpected end of: %s" % self.text)
+        raise ValueError("unexpected '%s' in: %s" % (value, self.text))
+
+    # ------------------------------------------------------ evaluation
+    @classmethod
+    def truth(cls, value):
+        if isinstance(value, RpmVersion):
+            return True
+        return bool(value)
+
+    @classmethod
+    def value(cls, tree):
+        op = tree[0]
+        if op == "=":
+            return tree[1]
+        if op == "?":
+            if cls.truth(cls.value(tree[1])):
+                return cls.value(tree[2])
+            return cls.value(tree[3])
+        if op == "&&":
+            left = cls.value(tree[1])
+            return cls.value(tree[2]) if cls.truth(left) else left
+        if op == "||":
+            left = cls.value(tree[1])
+            return left if cls.truth(left) else cls.value(tree[2])
+        if op == "!x":
+            return int(not cls.truth(cls.value(tree[1])))
+        if op == "-x":
+            value = cls.value(tree[1])
+            if not isinstance(value, int):
+                raise ValueError("- only on numbers: %s" % (value,))
+            return -value
+        left, right = cls.value(tree[1]), cls.value(tree[2])
+        if op in cls._compare:
+            return int(cls._compare[op](cls.cmp(left, right)))
+        if op == "+" and isinstance(left, str) and isinstance(right, str):
+            return left + right
+        if not isinstance(left, int) or not isinstance(right, int):
+            raise ValueError("%s only on numbers: %s %s" % (op, left, right))
+        if op == "+":
+            return left + right
+        if op == "-":
+            return left - right
+        if op == "*":
+            return left * right
+        if not right:
+            raise ValueError("division by zero")
+        quotient = abs(left) // abs(right)
+        return quotient if (left < 0) == (right < 0) else -quotient
+
+    @classmethod
+    def cmp(cls, left, right):
+        if isinstance(left, RpmVersion) or isinstance(right, RpmVersion):
+            if isinstance(left, str) or isinstance(right, str):
+                raise ValueError("types must match: %s %s" % (left, right))
+            left = left.evr if isinstance(left, RpmVersion) else str(left)
+            right = right.evr if isinstance(right, RpmVersion) else str(right)
+            return rpmevrcmp(left, right)
+        if type(left) != type(right):
+            raise ValueError("types must match: %s %s" % (left, right))
+        return (left > right) - (left < right)
+
+
+SpecEvent = collections.namedtuple("SpecEvent", ["kind", "name", "line", "found"])
+SpecToken = collections.namedtuple("SpecToken", ["line", "kind", "found"])
+
+
+class RpmSpecEvents:
+    """ Streaming scanner for rpm spec text. The events() generator takes any
+        iterable of lines (or a string) and yields one SpecEvent per line with
+        the kind being one of "comment", "default", "define", "setting",
+        "conditional", "section-start", "section-end", "directive", "text",
+        "skipped" or "unmatched". The name gives the rule (or the section for
+        text) and found is the match object for the line.
+        ...........................................................
+        The %if conditions are given to the condition callback which has to
+        return a boolean. Without a callback all branches are kept. """
+
+    on_variable = re.compile(r"\s*%(define|global)\s+(\S+)\s+(.*)")
+    on_architecture = re.compile(r"buildarch\s*:\s*(\S.*)", re.IGNORECASE)
+    on_setting = re.compile(r"\s*(\w+)\s*:\s*(\S.*)")
+    on_new_if = re.compile(r"%if\b(.*)")
+    on_else = re.compile(r"%else\b(.*)")
+    on_elif = re.compile(r"%elif\b(.*)")
+    on_end_if = re.compile(r"%endif\b(.*)")
+    on_bcond = re.compile(r"%(bcond_with|bcond_without)\s+(\w+)")
+    on_default_var1 = re.compile(
+        r"\s*%\{!\?(\w+):\s+%(define|global)\s+\1\b(.*)\}")
+    on_default_var2 = re.compile(
+        r"\s*[%][{][!][?](\w+)[:]\s*[%][{][?](\w+)[:]\s*[%](define|global)\s+\1\b(.*)[}][}]")
+    # %package [ -n package-name ] [ subpackage ]
+    on_package = re.compile(r"%(package)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+    # %description [ -n package-name ] [ subpackage ]
+    on_description = re.compile(
+        r"%(description)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+    on_changelog = re.compile(r"%(changelog)(\s*)")
+    on_rules = re.compile(r"%(prep|build|install|check|clean)\b(?:\s+(-.*))?")
+    on_scripts = re.compile(
+        r"%(post|postun|pre|preun)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+    # %files [ -f /path/to/filename ] [ subpackage ]
+    on_files = re.compile(r"%(files)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+    on_debug_package = re.compile(r"%(debug_package)(\s*)")
+    on_ghost = re.compile(r"%(ghost)\s.*")
+
+    # the keyword after the leading "%" selects the only rules that may match
+    on_keyword = re.compile(r"(\s*)%(\w+|\{!\?)")
+    _indented_keywords = ("{!?", "define", "global")
+    _keyword_rules = {
+        "{!?": (("default_var1", on_default_var1),
+                ("default_var2", on_default_var2)),
+        "define": (("variable", on_variable),),
+        "global": (("variable", on_variable),),
+        "bcond_with": (("bcond", on_bcond),),
+        "bcond_without": (("bcond", on_bcond),),
+        "if": (("new_if", on_new_if),),
+        "elif": (("new_elif", on_elif),),
+        "else": (("new_else", on_else),),
+        "endif": (("end_if", on_end_if),),
+        "package": (("package", on_package),),
+        "description": (("description", on_description),),
+        "prep": (("rules", on_rules),),
+        "build": (("rules", on_rules),),
+        "install": (("rules", on_rules),),
+        "check": (("rules", on_rules),),
+        "clean": (("rules", on_rules),),
+        "post": (("scripts", on_scripts),),
+        "postun": (("scripts", on_scripts),),
+        "pre": (("scripts", on_scripts),),
+        "preun": (("scripts", on_scripts),),
+        "files": (("files", on_files),),
+        "ghost": (("ghost", on_ghost),),
+        "changelog": (("changelog", on_changelog),),
+        "debug_package": (("debug_package", on_debug_package),),
+    }
+
+    # per state the kinds of lines being handled - anything else is text
+    _section_starts = ("package", "description", "rules", "scripts",
+                       "files", "changelog", "debug_package")
+    _conditionals = ("new_if", "new_elif", "new_else", "end_if")
+    _state_kinds = {
+        "package": frozenset(("comment", "default_var1", "default_var2")
+                             + _conditionals
+                             + ("variable", "bcond", "architecture", "setting")
+                             + _section_starts),
+        "description": frozenset(_conditionals + _section_starts),
+        "rules": frozenset(_conditionals + ("variable",) + _section_starts),
+        "scripts": frozenset(_conditionals + _section_starts),
+        "files": frozenset(_conditionals + ("ghost",) + _section_starts),
+        "changelog": frozenset(_section_starts),
+    }
+    _event_kinds = {
+        "comment": "comment",
+        "default_var1": "default",
+        "default_var2": "default",
+        "new_if": "conditional",
+        "new_elif": "conditional",
+        "new_else": "conditional",
+        "end_if": "conditional",
+        "variable": "define",
+        "bcond": "define",
+        "architecture": "setting",
+        "setting": "setting",
+        "package": "section-start",
+        "description": "section-start",
+        "rules": "section-start",
+        "scripts": "section-start",
+        "files": "section-start",
+        "changelog": "section-start",
+        "debug_package": "directive",
+        "ghost": "directive",
+    }
+
+    def __init__(self, condition=None):
+        self.condition = condition
+        self.section = None
+        # the %if stack and the number of its skip-if/done-if entries
+        self.ifs = []
+        self.skipping = 0
+
+    def state(self):
+        return self.section
+
+    def classify(self, line):
+        """ match a spec line just once, returns the kind of line and the
+            match object for its handler (or None, None for plain text) """
+        if line.startswith("#"):
+            return "comment", None
+        found = self.on_keyword.match(line)
+        if found:
+            indent, keyword = found.groups()
+            if not indent or keyword in self._indented_keywords:
+                for kind, rule in self._keyword_rules.get(keyword, ()):
+                    found = rule.match(line)
+                    if found:
+                        return kind, found
+            return None, None
+        found = self.on_setting.match(line)
+        if found:
+            if found.group(1).lower() == "buildarch":
+                found_architecture = self.on_architecture.match(line)
+                if found_architecture:
+                    return "architecture", found_architecture
+            return "setting", found
+        return None, None
+
+    def new_if(self, found_new_if):
+        condition, = found_new_if.groups()
+        if self.skipping:
+            # nested in a skipped block: no branch is taken or evaluated
+            self.ifs.append("done-if")
+            self.skipping += 1
+        elif self.condition is None or self.condition(condition):
+            self.ifs.append("keep-if")
+        else:
+            self.ifs.append("skip-if")
+            self.skipping += 1
+
+    def new_elif(self, found_elif):
+        condition, = found_elif.groups()
+        if not self.ifs:
+            _log.error("unmatched %elif with no preceding %if")
+        elif self.ifs[-1] == "skip-if":
+            if self.condition(condition):
+                self.ifs[-1] = "keep-if"
+                self.skipping -= 1
+        elif self.ifs[-1] == "keep-if":
+            if self.condition is not None:
+                self.ifs[-1] = "done-if"
+                self.skipping += 1
+
+    def new_else(self, found_else=None):
+        if not self.ifs:
+            _log.error("unmatched %else with no preceding %if")
+        elif self.ifs[-1] == "skip-if":
+            self.ifs[-1] = "keep-if"
+            self.skipping -= 1
+        elif self.ifs[-1] == "keep-if":
+            if self.condition is not None:
+                self.ifs[-1] = "done-if"
+                self.skipping += 1
+
+    def end_if(self, found_end_if=None):
+        if not self.ifs:
+            _log.error("unmatched %endif with no preceding %if")
+        elif self.ifs.pop() != "keep-if":
+            self.skipping -= 1
+
+    def skip_if(self):
+        return self.skipping > 0
+
+    def tokens(self, lines):
+        if isinstance(lines, str):
+            lines = lines.splitlines(True)
+        for line in lines:
+            kind, found = self.classify(line)
+            yield SpecToken(line, kind, found)
+
+    def events(self, lines):
+        """ lines may also be RpmSpecTokens that were classified before """
+        if isinstance(lines, RpmSpecTokens):
+            tokens = lines.tokens
+        else:
+            tokens = self.tokens(lines)
+        # the preamble is the header of the main package
+        self.section = "package"
+        self.ifs = []
+        self.skipping = 0
+        yield SpecEvent("section-start", "package", "",
+                        self.on_package.match("%package "))
+        for token in tokens:
+            for event in self.line_events(token):
+                yield event
+        if self.skip_if():
+            _log.error("end of while in skip-if section")
+        if self.state() != "package":
+            yield SpecEvent("section-end", self.state(), "", None)
+
+    def line_events(self, token):
+        state = self.state()
+        line, kind, found = token
+        if kind not in self._state_kinds[state]:
+            kind = None
+        if kind in self._section_starts and state != "package":
+            yield SpecEvent("section-end", state, line, None)
+        if kind in self._conditionals:
+            getattr(self, kind)(found)
+            yield SpecEvent("conditional", kind, line, found)
+            return
+        if kind in ("comment", "default_var1", "default_var2"):
+            yield SpecEvent(self._event_kinds[kind], kind, line, found)
+            return
+        if state != "changelog" and self.skip_if():
+            yield SpecEvent("skipped", state, line, found)
+            return
+        if kind:
+            if kind in self._state_kinds:
+                self.section = kind
+            yield SpecEvent(self._event_kinds[kind], kind, line, found)
+        elif state == "package" and line.strip():
+            yield SpecEvent("unmatched", state, line, None)
+        else:
+            yield SpecEvent("text", state, line, None)
+
+
+class RpmSpecTokens:
+    """ A spec that has been read and classified once. parse() replays the
+        tokens through the section and %if state of RpmSpecEvents with the
+        current variables, so a spec can be converted for any number of
+        --define sets without matching a single line again. """
+
+    def __init__(self, lines):
+        self.tokens = list(RpmSpecEvents().tokens(lines))
+
+    @classmethod
+    def read(cls, rpmspec):
+        with io.open(rpmspec, 'r', encoding='utf8') as f:
+            return cls(f)
+
+    def conditions(self):
+        """ the distinct %if/%elif conditions (unexpanded) """
+        conditions = []
+        for event in RpmSpecEvents().events(self):
+            if event.kind == "conditional" and event.name in ("new_if", "new_elif"):
+                condition = event.found.group(1).strip()
+                if condition not in conditions:
+                    conditions.append(condition)
+        return conditions
+
 
 class RpmSpecToDebianControl:
-    on_comment = re.compile("^#.*")
+    # the macro layers in self.var (and self.typed) by precedence - a name
+    # in the debian layer is final while the others are overridden by set()
+    spec_layer = 0
+    define_layer = 1
+    debian_layer = 2
+    macrofile_layer = 3
+    default_layer = 4
 
     def __init__(self):
         self.debian_file = None
@@ -155,11 +1767,30 @@ class RpmSpecToDebianControl:
         self.packages = {}
         self.package = ""
         self.section = ""
-        self.sectiontext = ""
-        self.states = []
-        self.var = {"autoreqprov": "yes"}
-        self.typed = {"autoreqprov": "global"}
-        self.rpm_macros = []
+        self.sectionlines = []
+        self.var = collections.ChainMap(
+            {}, {}, _debian_macros, {}, _default_macros)
+        self.typed = collections.ChainMap(
+            {}, {}, _debian_typed, {}, _default_typed)
+        self.macro_files_digest = None
+        self.shell = RpmShellRunner() if shell_expansion else None
+        self.package_mapping = None
+        self._deb_relations = {}
+        self.apt_index = None
+        self.group_sections = None
+        self.compresslevel = compresslevel
+        self.write_buffer_size = write_buffer_size
+        self.gzip_mtime = gzip_mtime
+        self.recompress_buffer_size = recompress_buffer_size
+        self.recompress_memlimit = recompress_memlimit
+        self.gzip_threads = gzip_threads
+        self.orig_placement = orig_placement
+        self.hash_buffer_size = hash_buffer_size
+        self.written_digests = {}
+        self.manifest = None
+        self.spec_files = []
+        self._parsed_post = {}
+        self.rpm_macros = _default_macro_names
         self.urgency = urgency
         self.promote = promote
         self.package_importance = package_importance
@@ -169,20 +1800,30 @@ class RpmSpecToDebianControl:
         self.debtransform = debtransform
         self.check = check
         self.strip = strip
-        self.scan_macros(usr_lib_rpm_macros, "default")
-        self.scan_macros(debian_special_macros, "debian")
-        self.cache_packages2 = []
-        self.cache_version = None
-        self.cache_revision = None
+        self.parse_cache_dir = parse_cache_dir
+        self._compiled_macros = {}
+        self._resolving = []
+        self._expanding = None
+        self._expanded = {}
+        self._dependents = {}
+        self._recursions = 0
+        self.macro_hits = 0
+        self.macro_misses = 0
 
     def has_names(self):
-        return list(self.var.keys())
+        """ the names from the default layer up to the spec layer, each
+            where it came first - ChainMap itself has no stable order """
+        names = {}
+        for layer in reversed(self.var.maps):
+            for name in layer:
+                names.setdefault(name, None)
+        return list(names)
 
     def has_rpm_macros(self):
         return self.rpm_macros
 
     def is_default(self, name):
-        if self.has(name) and self.typed[name] == 'default':
+        if self.has(name) and self.typed[name] in ('default', 'macrofile'):
             return True
         return False
 
@@ -201,34 +1842,58 @@ class RpmSpecToDebianControl:
             return self.var[name]
         return default
 
-    def set(self, name, value, typed):
+    def set(self, name, value, typed, layer=spec_layer):
+        if name in self.var.maps[self.debian_layer]:
+            _log.debug("ignore %s var '%s'", self.typed[name], name)
+            return
         if name in self.var:
-            if self.typed[name] == "debian":
-                _log.debug("ignore %s var '%s'", self.typed[name], name)
-                return
             if self.var[name] != value:
                 _log.info("override %s %s %s (was %s)",
                           typed, name, value, self.var[name])
-        self.var[name] = value
-        self.typed[name] = typed
+                self.invalidate(name)
+        else:
+            self.invalidate(name)
+        self.var.maps[layer][name] = value
+        self.typed.maps[layer][name] = typed
+        if self.shell is not None and "%" in value:
+            self.prefetch_commands(value)
         if typed == "default":
-            self.rpm_macros.append(name)
+            # copy-on-write as the initial list is shared
+            self.rpm_macros = self.rpm_macros + [name]
         return self
 
+    def define(self, name, value):
+        """ a command line --define which the spec may override """
+        return self.set(name, value, "define", self.define_layer)
+
     def scan_macros(self, text, typed):
-        definition = re.compile("\s*[%](\w+)\s+(.*)")
-        for line in text.split("\n"):
-            found = definition.match(line)
-            if found:
-                name, value = found.groups()
-                self.set(name, value.strip(), typed)
+        for name, value in scan_macro_table(text).items():
+            self.set(name, value, typed)
         return self
-    # ========================================================= PARSER
 
-    def state(self):
-        if not self.states:
-            return None
-        return self.states[0]
+    def load_macro_files(self, patterns, cache_dir=None):
+        """ use rpm macro files (e.g. /usr/lib/rpm/macros) in place of the
+            builtin defaults - see RpmMacroIndex """
+        index = RpmMacroIndex(patterns, cache_dir).load()
+        self.var.maps[self.macrofile_layer] = index.macros
+        self.typed.maps[self.macrofile_layer] = index.typed
+        self.macro_files_digest = index.digest
+        self.invalidate()
+        return index
+
+    def invalidate(self, name=None):
+        """ forget the memoized expansion of the name and of all the macros
+            that have been using it (or of everything without a name) """
+        if name is None:
+            self._expanded.clear()
+            self._dependents.clear()
+            return
+        names = [name]
+        while names:
+            name = names.pop()
+            self._expanded.pop(name, None)
+            names.extend(self._dependents.pop(name, ()))
+    # ========================================================= PARSER
 
     def set_source_format(self, value):
         if value in _source_formats:
@@ -245,11 +1910,6 @@ class RpmSpecToDebianControl:
         elif value:
             _log.fatal("unknown package_importance: '%s'" % value)
 
-    def new_state(self, state):
-        if not self.states:
-            self.states = [""]
-        self.states[0] = state
-
     # %files -n explicit-package-name
     on_explicit_package = re.compile(r"-n\s+(\S+)")
     # %files -f list-of-files
@@ -290,8 +1950,10 @@ while read line; do
 done < {files}""".format(
                 files=found.group(1), package_name=self.deb_package_name(self.expand(self.package))))
 
+    # a name may be a file path, "perl(Foo::Bar)" or "libfoo.so.1()(64bit)"
     on_requires = re.compile(
-        r"([\w.+_-]+(\s+(=>|>=|>|<|=<|<=|=|==)\s+(\w+:)?[\w.~+_-]+)?)")
+        r"((?:/[^\s,()]+|[\w.+_-]+(?:[(][^()\s,]*[)])*)"
+        r"(\s+(=>|>=|>|<|=<|<=|=|==)\s+(\w+:)?[\w.~+_-]+)?)")
 
     def append_setting(self, name, value):
         package_sections = ["requires", "buildrequires", "prereq",
@@ -321,24 +1983,37 @@ done < {files}""".format(
             else:
                 _log.debug("ignored to add a setting '%s'", name)
         else:
+            # the package value may shadow a global one in get()
+            self.invalidate(name)
             if name not in package_sections:
                 _log.debug(
                     "ignored to add a setting '%s' from package '%s'", name, self.package)
 
     def new_section(self, section, text=""):
         self.section = section.strip()
-        self.sectiontext = text
+        self.sectionlines = [text]
 
     def append_section(self, text=None):
-        self.sectiontext += text or ""
+        if text:
+            self.sectionlines.append(text)
 
-    on_variable = re.compile(r"\s*%(define|global)\s+(\S+)\s+(.*)")
+    def section_text(self):
+        return "".join(self.sectionlines)
 
     def save_variable(self, found_variable):
         typed, name, value = found_variable.groups()
         self.set(name.strip(), value.strip(), typed)
 
-    on_architecture = re.compile(r"buildarch\s*:\s*(\S.*)", re.IGNORECASE)
+    def save_bcond(self, found_bcond):
+        """ %bcond_with x is off unless _with_x is defined (rpmbuild --with x)
+            and %bcond_without x is on unless _without_x is defined. """
+        typed, name = found_bcond.groups()
+        if typed == "bcond_with":
+            enabled = self.has("_with_" + name)
+        else:
+            enabled = not self.has("_without_" + name)
+        if enabled and not self.has("with_" + name):
+            self.set("with_" + name, "1", "global")
 
     def save_architecture(self, found_architecture):
         value, = found_architecture.groups()
@@ -346,51 +2021,10 @@ done < {files}""".format(
             value = 'all'
         self.append_setting("architecture", value)
 
-    on_setting = re.compile(r"\s*(\w+)\s*:\s*(\S.*)")
-
     def save_setting(self, found_setting):
         name, value = found_setting.groups()
         self.append_setting(name.lower(), value)
 
-    on_new_if = re.compile(r"%if\b(.*)")
-    on_else = re.compile(r"%else\b(.*)")
-    on_end_if = re.compile(r"%endif\b(.*)")
-
-    def new_if(self, found_new_if):
-        condition, = found_new_if.groups()
-        condition = self.expand(condition)
-        condition_result = False
-        try:
-            condition_result = eval(condition)
-        except SyntaxError:
-            print('SyntaxError exception during evaluation of ' + condition)
-        if condition_result:
-            self.states.append("keep-if")
-        else:
-            self.states.append("skip-if")
-
-    def new_else(self):
-        if self.states[-1] == "skip-if":
-            self.states[-1] = "keep-if"
-        elif self.states[-1] == "keep-if":
-            self.states[-1] = "skip-if"
-        else:
-            _log.error("unmatched %else with no preceding %if")
-
-    def end_if(self):
-        if self.states[-1] in ["skip-if", "keep-if"]:
-            self.states = self.states[:-1]
-        else:
-            _log.error("unmatched %endif with no preceding %if")
-
-    def skip_if(self):
-        if "skip-if" in self.states:
-            return True
-        return False
-
-    on_default_var1 = re.compile(
-        r"\s*%\{!\?(\w+):\s+%(define|global)\s+\1\b(.*)\}")
-
     def default_var1(self, found_default_var):
         name, typed, value = found_default_var.groups()
         if not self.has(name):
@@ -401,9 +2035,6 @@ done < {files}""".format(
             _log.warning(
                 "do not use %%define in default-variables, use %%global %s", name)
 
-    on_default_var2 = re.compile(
-        r"\s*[%][{][!][?](\w+)[:]\s*[%][{][?](\w+)[:]\s*[%](define|global)\s+\1\b(.*)[}][}]")
-
     def default_var2(self, found_default_var):
         name, name2, typed, value = found_default_var.groups()
         if not self.has(name2):
@@ -431,403 +2062,361 @@ done < {files}""".format(
             _log.warning(
                 "do not use %%define in default-variables, use %%global %s", name)
 
-    # %package [ -n package-name ] [ subpackage ]
-    on_package = re.compile(r"%(package)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
-
     def start_package(self, found_package):
         _, package, options = found_package.groups()
         self.new_package(package, options)
-        self.new_state("package")
-
-    # %description [ -n package-name ] [ subpackage ]
-    on_description = re.compile(
-        r"%(description)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
 
     def start_description(self, found_description):
         rule, package, options = found_description.groups()
         self.new_package(package, options)
         self.new_section("%"+rule.strip())
-        self.new_state("description")
 
     def endof_description(self):
-        self.append_setting(self.section, self.sectiontext)
-
-    on_changelog = re.compile(r"%(changelog)(\s*)")
+        self.append_setting(self.section, self.section_text())
 
     def start_changelog(self, found_changelog):
         rule, options = found_changelog.groups()
         self.new_package("", options)
         self.new_section("%"+rule.strip())
-        self.new_state("changelog")
 
     def endof_changelog(self):
-        self.append_setting(self.section, self.sectiontext)
-
-    on_rules = re.compile(r"%(prep|build|install|check|clean)\b(?:\s+(-.*))?")
+        self.append_setting(self.section, self.section_text())
 
     def start_rules(self, found_rules):
         rule, options = found_rules.groups()
         self.new_package("", options)
         self.section = rule.strip()
         self.new_section("%"+rule.strip())
-        self.new_state("rules")
 
     def endof_rules(self):
-        self.append_setting(self.section, self.sectiontext)
-
-    on_scripts = re.compile(
-        r"%(post|postun|pre|preun)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+        self.append_setting(self.section, self.section_text())
 
     def start_scripts(self, found_scripts):
         rule, package, options = found_scripts.groups()
         self.new_package(package, options)
         self.new_section("%"+rule.strip())
-        self.new_state("scripts")
 
     def endof_scripts(self):
-        self.append_setting(self.section, self.sectiontext)
-
-    # %files [ -f /path/to/filename ] [ subpackage ]
-    on_files = re.compile(r"%(files)\b(?:\s+([^-]\S*))?(?:\s+(-.*))?")
+        self.append_setting(self.section, self.section_text())
 
     def start_files(self, found_files):
         rule, package, options = found_files.groups()
         self.new_package(package, options)
         self.new_section("%"+rule)
-        self.new_state("files")
 
     def endof_files(self):
-        self.append_setting(self.section, self.sectiontext)
+        self.append_setting(self.section, self.section_text())
 
-    on_debug_package = re.compile(r"%(debug_package)(\s*)")
-
-    def set_debug_package(self):
+    def set_debug_package(self, found_debug_package=None):
         _log.warning(
             "Debug package detected but still not handled.")
 
-    on_ghost = re.compile(r"%(ghost)\s.*")
+    def skip_ghost(self, found_ghost=None):
+        print("skipping ghost line in files section")
+
+    _event_handlers = {
+        "default_var1": "default_var1",
+        "default_var2": "default_var2",
+        "variable": "save_variable",
+        "bcond": "save_bcond",
+        "architecture": "save_architecture",
+        "setting": "save_setting",
+        "package": "start_package",
+        "description": "start_description",
+        "rules": "start_rules",
+        "scripts": "start_scripts",
+        "files": "start_files",
+        "changelog": "start_changelog",
+        "debug_package": "set_debug_package",
+        "ghost": "skip_ghost",
+    }
+
+    def eval_condition(self, condition):
+        condition = self.expand(condition)
+        try:
+            return RpmExpression.true(condition)
+        except ValueError as e:
+            _log.error("can not evaluate %%if %s: %s", condition.strip(), e)
+        return False
+
+    def parse_event(self, event):
+        kind, name, line, found = event
+        if kind == "text":
+            if name == "files":
+                line = line.replace("(noreplace)", "")
+            if name != "package":
+                self.append_section(line)
+        elif kind == "section-end":
+            getattr(self, "endof_" + name)()
+        elif kind == "unmatched":
+            _log.error("%s unmatched line:\n %s", name, line)
+        elif kind in ("default", "define", "setting", "section-start", "directive"):
+            getattr(self, self._event_handlers[name])(found)
 
     def parse(self, rpmspec):
-        default = "%package "
-        found_package = self.on_package.match(default)
-        assert found_package
-        self.start_package(found_package)
-        for line in io.open(rpmspec, 'r', encoding='utf8'):
-            if self.state() in ["package"]:
-                found_default_var1 = self.on_default_var1.match(line)
-                found_default_var2 = self.on_default_var2.match(line)
-                found_new_if = self.on_new_if.match(line)
-                found_else = self.on_else.match(line)
-                found_end_if = self.on_end_if.match(line)
-                found_comment = self.on_comment.match(line)
-                found_variable = self.on_variable.match(line)
-                found_architecture = self.on_architecture.match(line)
-                found_setting = self.on_setting.match(line)
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if found_comment:
-                    # ignore comments
-                    pass
-                elif found_default_var1:
-                    self.default_var1(found_default_var1)
-                elif found_default_var2:
-                    self.default_var2(found_default_var2)
-                elif found_new_if:
-                    self.new_if(found_new_if)
-                elif found_else:
-                    self.new_else()
-                elif found_end_if:
-                    self.end_if()
-                elif self.skip_if():
+        """ rpmspec is a filename or an iterable of lines (e.g. sys.stdin)
+            or RpmSpecTokens to be evaluated with the current variables """
+        if isinstance(rpmspec, str):
+            if rpmspec not in self.spec_files:
+                self.spec_files.append(rpmspec)
+            if self.parse_cache_dir:
+                return self.parse_cached(rpmspec)
+            with io.open(rpmspec, 'r', encoding='utf8') as f:
+                return self.parse(f)
+        scanner = RpmSpecEvents(self.eval_condition)
+        for event in scanner.events(rpmspec):
+            self.parse_event(event)
+
+    def parse_cache_key(self, data):
+        """ the parse result depends on the spec text and on the variables
+            known beforehand (builtin macros, --define values, ...) as well
+            as on what expands them - the shell commands and the package
+            names of the mapping and the apt index """
+        # the macro files layer is represented by its digest
+        layers = [n for n in range(len(self.var.maps)) if n != self.macrofile_layer]
+        shell = None
+        if self.shell is not None:
+            shell = [shell_timeout, self.shell.budget]
+        mapping = None
+        if self.package_mapping is not None:
+            mapping = self.package_mapping.index_key()
+        apt = None
+        if self.apt_index is not None:
+            apt = os.path.basename(self.apt_index.index_file())
+        state = [_parse_cache_format, self.macro_files_digest,
+                 [self.var.maps[n] for n in layers],
+                 [self.typed.maps[n] for n in layers],
+                 self.rpm_macros, self.packages, self.package,
+                 shell, mapping, apt]
+        d = hashlib.sha256(data)
+        d.update(json.dumps(state, sort_keys=True).encode('utf-8'))
+        return d.hexdigest()
+
+    def parse_cached(self, rpmspec):
+        with open(rpmspec, 'rb') as f:
+            data = f.read()
+        cache_dir = os.path.expanduser(self.parse_cache_dir)
+        cache_file = os.path.join(cache_dir, self.parse_cache_key(data) + ".json")
+        try:
+            with open(cache_file, 'rb') as f:
+                model = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            model = None
+        if model:
+            _log.debug("using cached parse of '%s': %s", rpmspec, cache_file)
+            self.packages = model["packages"]
+            self.var.maps[self.spec_layer] = model["var"]
+            self.typed.maps[self.spec_layer] = model["typed"]
+            self.rpm_macros = model["rpm_macros"]
+            self.package = model["package"]
+            self.invalidate()
+            return
+        self.parse(io.TextIOWrapper(io.BytesIO(data), encoding='utf8'))
+        model = {"packages": self.packages,
+                 "var": self.var.maps[self.spec_layer],
+                 "typed": self.typed.maps[self.spec_layer],
+                 "rpm_macros": self.rpm_macros,
+                 "package": self.package}
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_file = "%s.%i.tmp" % (cache_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                f.write(json.dumps(model, separators=(',', ':')).encode('utf-8'))
+            os.replace(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            _log.warning("can not write parse cache %s: %s", cache_file, e)
+
+    # %name, %{name}, %{?name}, %{!?name}, %{?name:body}, %{!?name:body}
+    # and %{with name}, %{without name}, %(command), %{lua:code} - where
+    # "%%" is kept as is and the braces are counted within a body
+    on_macro_token = re.compile(
+        r"[%]([%]|\w+|[(]|[{](!?[?])?(\w+)([:}])|[{](with|without)\s+(\w+)[}])|([{}])")
+    _unexpanded_names = ("setup", "defattr", "dir", "attr", "config")
+
+    def compile_macros(self, text):
+        """ parse text into a tuple of literal strings and macro nodes
+            (form, name, body, raw) - the body is a compiled tuple again """
+        nodes = self._compiled_macros.get(text)
+        if nodes is None:
+            nodes, _ = self._compile_macros(text, 0, False)
+            self._compiled_macros[text] = nodes
+        return nodes
+
+    def _compile_macros(self, text, pos, nested):
+        nodes = []
+        depth = 0
+        literal = pos
+        while True:
+            found = self.on_macro_token.search(text, pos)
+            if not found:
+                if nested:
+                    return None, pos
+                break
+            word, mark, name, ends, bcond, bcond_name, brace = found.groups()
+            if brace:
+                pos = found.end()
+                if not nested:
                     continue
-                elif found_variable:
-                    self.save_variable(found_variable)
-                elif found_architecture:
-                    self.save_architecture(found_architecture)
-                elif found_setting:
-                    self.save_setting(found_setting)
-                elif found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                elif line.strip():
-                    # line is not empty...
-                    _log.error("%s unmatched line:\n %s", self.state(), line)
-            elif self.state() in ["description"]:
-                found_new_if = self.on_new_if.match(line)
-                found_else = self.on_else.match(line)
-                found_end_if = self.on_end_if.match(line)
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if (found_package or found_description or found_rules or found_scripts
-                        or found_files or found_changelog or found_debug_package):
-                    self.endof_description()
-                if found_new_if:
-                    self.new_if(found_new_if)
-                elif found_else:
-                    self.new_else()
-                elif found_end_if:
-                    self.end_if()
-                elif self.skip_if():
+                if brace == "{":
+                    depth += 1
                     continue
-                elif found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                else:
-                    self.append_section(line)
-            elif self.state() in ["rules"]:
-                found_new_if = self.on_new_if.match(line)
-                found_else = self.on_else.match(line)
-                found_end_if = self.on_end_if.match(line)
-                found_variable = self.on_variable.match(line)
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if (found_package or found_description or found_rules or found_scripts
-                        or found_files or found_changelog or found_debug_package):
-                    self.endof_files()
-                if found_new_if:
-                    self.new_if(found_new_if)
-                elif found_else:
-                    self.new_else()
-                elif found_end_if:
-                    self.end_if()
-                elif self.skip_if():
+                if depth:
+                    depth -= 1
                     continue
-                elif found_variable:
-                    self.save_variable(found_variable)
-                elif found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                else:
-                    self.append_section(line)
-            elif self.state() in ["scripts"]:
-                found_new_if = self.on_new_if.match(line)
-                found_else = self.on_else.match(line)
-                found_end_if = self.on_end_if.match(line)
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if (found_package or found_description or found_rules or found_scripts
-                        or found_files or found_changelog or found_debug_package):
-                    self.endof_scripts()
-                if found_new_if:
-                    self.new_if(found_new_if)
-                elif found_else:
-                    self.new_else()
-                elif found_end_if:
-                    self.end_if()
-                elif self.skip_if():
+                if literal < found.start():
+                    nodes.append(text[literal:found.start()])
+                return tuple(nodes), pos
+            if word == "%":
+                pos = found.end()
+                continue
+            if word == "(":
+                end = self.balanced_end(text, found.end(), "(", ")")
+                if end is None:
+                    pos = found.start() + 1
                     continue
-                elif found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                else:
-                    self.append_section(line)
-            elif self.state() in ["files"]:
-                found_new_if = self.on_new_if.match(line)
-                found_else = self.on_else.match(line)
-                found_end_if = self.on_end_if.match(line)
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_ghost = self.on_ghost.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if (found_package or found_description or found_rules or found_scripts
-                        or found_files or found_changelog or found_debug_package):
-                    self.endof_files()
-                if found_new_if:
-                    self.new_if(found_new_if)
-                elif found_else:
-                    self.new_else()
-                elif found_end_if:
-                    self.end_if()
-                elif self.skip_if():
+                node = ("shell", None, text[found.end():end - 1], text[found.start():end])
+                pos = end
+            elif bcond:
+                node = (bcond, "with_" + bcond_name, None, found.group(0))
+                pos = found.end()
+            elif name is None:
+                node = ("plain", word, None, found.group(0))
+                pos = found.end()
+            elif ends == "}":
+                form = {None: "braced", "?": "if", "!?": "ifnot"}[mark]
+                node = (form, name, None, found.group(0))
+                pos = found.end()
+            elif mark:
+                body, end = self._compile_macros(text, found.end(), True)
+                if body is None:
+                    # unterminated body - that is just text
+                    pos = found.start() + 1
                     continue
-                elif found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_ghost:
-                    print("skipping ghost line in files section")
+                form = {"?": "if", "!?": "ifnot"}[mark]
+                node = (form, name, body, text[found.start():end])
+                pos = end
+            elif name == "lua":
+                end = self.balanced_end(text, found.end(), "{", "}")
+                if end is None:
+                    pos = found.start() + 1
                     continue
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                else:
-                    line = line.replace("(noreplace)", "")
-                    self.append_section(line)
-            elif self.state() in ["changelog"]:
-                found_package = self.on_package.match(line)
-                found_description = self.on_description.match(line)
-                found_rules = self.on_rules.match(line)
-                found_scripts = self.on_scripts.match(line)
-                found_files = self.on_files.match(line)
-                found_changelog = self.on_changelog.match(line)
-                found_debug_package = self.on_debug_package.match(line)
-                if (found_package or found_description or found_rules or found_scripts
-                        or found_files or found_changelog or found_debug_package):
-                    self.endof_description()
-                if found_package:
-                    self.start_package(found_package)
-                elif found_description:
-                    self.start_description(found_description)
-                elif found_rules:
-                    self.start_rules(found_rules)
-                elif found_scripts:
-                    self.start_scripts(found_scripts)
-                elif found_files:
-                    self.start_files(found_files)
-                elif found_changelog:
-                    self.start_changelog(found_changelog)
-                elif found_debug_package:
-                    self.set_debug_package()
-                else:
-                    self.append_section(line)
+                node = ("lua", None, text[found.end():end - 1], text[found.start():end])
+                pos = end
             else:
-                _log.fatal("UNKNOWN state %s", self.states)
-        # for line
-        if self.skip_if():
-            self.error("end of while in skip-if section")
-        if self.state() in ["package"]:
-            # nothing to do...
-            pass
-        elif self.state() in ["description"]:
-            self.endof_description()
-        elif self.state() in ["rules"]:
-            self.endof_rules()
-        elif self.state() in ["scripts"]:
-            self.endof_scripts()
-        elif self.state() in ["files"]:
-            self.endof_files()
-        elif self.state() in ["changelog"]:
-            self.endof_changelog()
-        else:
-            _log.fatal("UNKNOWN state %s (at end of file)", self.states)
-
-    on_embedded_name = re.compile(r"[%](\w+)\b")
-    on_required_name = re.compile(r"[%][{](\w+)[}]")
-    on_optional_name = re.compile(r"[%][{]([!]?[?])(\w+):?(\w+)?[}]")
+                # %{name:...} is not supported - that is just text
+                pos = found.start() + 1
+                continue
+            if literal < found.start():
+                nodes.append(text[literal:found.start()])
+            nodes.append(node)
+            literal = pos
+        if literal < len(text):
+            nodes.append(text[literal:])
+        return tuple(nodes), len(text)
+
+    @staticmethod
+    def balanced_end(text, pos, opening, closing):
+        """ the end of the text up to the closing mark (or None) """
+        depth = 0
+        for end in range(pos, len(text)):
+            if text[end] == opening:
+                depth += 1
+            elif text[end] == closing:
+                if not depth:
+                    return end + 1
+                depth -= 1
+        return None
+
+    def render_macros(self, nodes):
+        parts = []
+        for node in nodes:
+            if isinstance(node, str):
+                parts.append(node)
+                continue
+            form, name, body, raw = node
+            if form in ("shell", "lua"):
+                parts.append(self.render_command(form, body, raw))
+                continue
+            if self._resolving:
+                self._dependents.setdefault(name, set()).add(self._resolving[-1])
+            if form in ("with", "without"):
+                parts.append("1" if self.has(name) == (form == "with") else "0")
+            elif form in ("if", "ifnot"):
+                if self.has(name) == (form == "if"):
+                    if body is not None:
+                        parts.append(self.render_macros(body))
+                    elif form == "if":
+                        parts.append(self.expand_macro(name, raw))
+            elif form == "plain" and name in self._unexpanded_names:
+                parts.append(raw)
+            elif self.has(name):
+                parts.append(self.expand_macro(name, raw))
+            else:
+                _log.error("unable to expand %s in: %s", raw, self._expanding)
+                parts.append(raw)
+        return "".join(parts)
+
+    def command_argv(self, form, body):
+        """ the %(command) is macro expanded while the %{lua:code} is not
+            (and without rpm's builtin lua modules only plain lua works) """
+        if form == "lua":
+            return ["lua", "-e", body]
+        return ["/bin/sh", "-c", self.render_macros(self.compile_macros(body))]
+
+    def render_command(self, form, body, raw):
+        if self.shell is None:
+            return raw
+        output = self.shell.output(self.command_argv(form, body))
+        if output is None:
+            return raw
+        return output
+
+    def prefetch_commands(self, value):
+        """ start the commands of a new definition ahead of its expansion
+            if all the macros in the command are known by now """
+        for node in self.compile_macros(value):
+            if isinstance(node, str) or node[0] not in ("shell", "lua"):
+                continue
+            names = [part[1] for part in self.compile_macros(node[2])
+                     if not isinstance(part, str)]
+            if node[0] == "lua" or all(name and self.has(name) for name in names):
+                self.shell.submit(self.command_argv(node[0], node[2]))
+
+    def expand_macro(self, name, raw):
+        """ the value of a macro fully expanded - the names being resolved
+            are tracked so that a cycle is detected at the first repeat. The
+            result is memoized per package context until set() changes the
+            macro or any macro it was using (see invalidate) """
+        if name in self._resolving:
+            _log.error("recursive macro %s in: %s", raw,
+                       " -> ".join(self._resolving + [name]))
+            self._recursions += 1
+            return raw
+        context = self.package if self.package != "%{name}" else ""
+        values = self._expanded.get(name)
+        if values and context in values:
+            self.macro_hits += 1
+            return values[context]
+        self.macro_misses += 1
+        recursions = self._recursions
+        self._resolving.append(name)
+        try:
+            value = self.render_macros(self.compile_macros(self.get(name)))
+        finally:
+            self._resolving.pop()
+        if recursions == self._recursions:
+            self._expanded.setdefault(name, {})[context] = value
+        return value
 
     def expand(self, text):
         orig = text
-        lines = text.split('\n')
-        for line_index in range(len(lines)):
-            line = lines[line_index]
-            for _ in range(100):
-                oldline = line
-                line = line.replace("%%", "\1")
-                for found in self.on_embedded_name.finditer(line):
-                    name, = found.groups()
-                    if name == 'setup' or name == 'defattr' or name == 'dir' or name == 'attr' or name == 'config':
-                        continue
-                    elif self.has(name):
-                        value = self.get(name)
-                        line = re.sub("%"+name+"\\b", value, line)
-                    else:
-                        _log.error("unable to expand %%%s in: %s", name, line)
-                line = line.replace("%%", "\1")
-                for found in self.on_required_name.finditer(line):
-                    name, = found.groups()
-                    if self.has(name):
-                        value = self.get(name)
-                        line = re.sub("%{"+name+"}", value, line)
-                    else:
-                        _log.error(
-                            "unable to expand %%{%s} in : %s", name, line)
-                line = line.replace("%%", "\1")
-                for found in self.on_optional_name.finditer(line):
-                    mark, name, replacement = found.groups()
-
-                    to_replace = "%{"
-                    to_replace += "\?" if (mark == '?') else "!\?"
-                    to_replace += name
-                    if (replacement):
-                        to_replace += ":" + replacement
-                    to_replace += "}"
-                    value = ''
-
-                    if (self.has(name) and mark == '?') or (not self.has(name) and mark == '!?'):
-                        value = replacement if replacement else self.get(name)
-                        line = re.sub(to_replace, value, line)
-
-                    line = re.sub(to_replace, value, line)
-                line = line.replace("\1", "%%")
-                if line == oldline:
-                    break
-            lines[line_index] = line
-        text = "\n".join(lines)
+        expanding = self._expanding
+        self._expanding = text
+        try:
+            text = self.render_macros(self.compile_macros(text))
+        finally:
+            self._expanding = expanding
         if "$(" in text and orig not in ["%buildroot", "%__make"]:
             _log.warning(
                 "expand of '%s' left a make variable:\n %s", orig, text)
@@ -838,15 +2427,6 @@ done < {files}""".format(
             yield deb
 
     def deb_packages2(self):
-        if self.cache_packages2:
-            for item in self.cache_packages2:
-                yield item
-        else:
-            for item in self._deb_packages2():
-                self.cache_packages2.append(item)
-                yield item
-
-    def _deb_packages2(self):
         for package in sorted(self.packages):
             deb_package = package
             # if deb_package == "%{name}" and len(self.packages) > 1:
@@ -861,64 +2441,70 @@ done < {files}""".format(
                 two characters long and must start with an alphanumeric. """
         if not package.startswith("${"):
             package = package.lower().replace("_", "")
-        if package in known_package_mapping:
-            package = known_package_mapping[package]
-        elif package.endswith("-devel"):
-            package = package[:-2]
-        return package
+        return (self.package_mapping or default_package_mapping()).get(package)
+
+    @property
+    def apt_index(self):
+        return self._apt_index
+
+    @apt_index.setter
+    def apt_index(self, apt_index):
+        """ the relations resolved so far may differ with another index """
+        self._apt_index = apt_index
+        self._deb_relations.clear()
+
+    def load_package_mapping(self, files, distro=None, cache_dir=None):
+        self.package_mapping = PackageMapping(files, distro, cache_dir).load()
+        self._deb_relations.clear()
+        return self.package_mapping
 
     def deb_build_depends(self):
         depends = ["debhelper (>= %s)" % self.debhelper_compat]
+        seen = set(depends)
         for package in self.packages:
             for buildrequires in self.packages[package].get("buildrequires", []):
                 depend = self.deb_requires(buildrequires)
-                if depend not in depends:
+                if depend not in seen:
+                    seen.add(depend)
                     depends.append(depend)
         return depends
 
     def deb_requires(self, requires):
-        requires = self.expand(requires)
-        withversion = re.match(
-            "(\S+)\s+(=>|>=|>|<|=<|<=|=|==)\s+(\S+)", requires)
-        if withversion:
-            package, relation, version = withversion.groups()
-            if relation == "<":
-                relation = "<<"
-            elif relation == ">":
-                relation = ">>"
-            elif relation == "=>":
-                relation = ">="
-            elif relation == "=<":
-                relation = "<="
-            elif relation == "==":
-                relation = "="
-            deb_package = self.deb_package_name(package)
-            return "%s (%s %s)" % (deb_package, relation, version)
-        else:
-            deb_package = self.deb_package_name(requires.strip())
+        relation = RpmRelation.parse(self.expand(requires))
+        key = ("requires", relation)
+        if key not in self._deb_relations:
+            deb_package = self.deb_require_name(relation.name)
+            if relation.operator:
+                deb_package = "%s (%s %s)" % (deb_package, relation.deb_operator(),
+                                              relation.version)
+            self._deb_relations[key] = deb_package
+        return self._deb_relations[key]
+
+    def deb_require_name(self, package):
+        """ the deb_package_name unless the apt index knows the package
+            for a file or library requirement """
+        if self.apt_index is None:
+            return self.deb_package_name(package)
+        deb_package = self.apt_index.resolve(package)
+        if deb_package:
             return deb_package
+        deb_package = self.deb_package_name(package)
+        if not deb_package.startswith("${") and not self.apt_index.has_package(deb_package):
+            _log.info("package %s (for %s) is not in the apt index", deb_package, package)
+        return deb_package
 
     def deb_provides(self, provides):
-        provides = self.expand(provides)
-        withversion = re.match(
-            "(\S+)\s+(=>|>=|>|<|=<|<=|=|==)\s+(\S+)", provides)
-        if withversion:
-            package, relation, version = withversion.groups()
-            if relation == "<":
-                relation = "<<"
-            elif relation == ">":
-                relation = ">>"
-            elif relation == "=>":
-                relation = ">="
-            elif relation == "=<":
-                relation = "<="
-            elif relation == "==":
-                relation = "="
-            deb_package = self.deb_package_name(package)
-            return "%s (%s %s)" % (deb_package, relation, version)
-        else:
-            deb_package = self.deb_package_name(provides.strip())
-            return "%s (= %s)" % (deb_package, self.deb_version())
+        relation = RpmRelation.parse(self.expand(provides))
+        key = ("provides", relation)
+        if key not in self._deb_relations:
+            deb_package = self.deb_package_name(relation.name)
+            if relation.operator:
+                deb_package = "%s (%s %s)" % (deb_package, relation.deb_operator(),
+                                              relation.version)
+            self._deb_relations[key] = deb_package
+        if relation.operator:
+            return self._deb_relations[key]
+        return "%s (= %s)" % (self._deb_relations[key], self.deb_version())
 
     def deb_sourcefile(self):
         sourcefile = self.get("source", self.get("source0"))
@@ -927,6 +2513,16 @@ done < {files}""".format(
             sourcefile = sourcefile[x+1:]
         return sourcefile
 
+    def deb_orig_suffix(self):
+        """ the orig tarball keeps the compression of Source0 where the
+            source format allows it, otherwise it is recompressed to gz """
+        sourcefile = self.expand(self.deb_sourcefile())
+        if "3." in self.source_format:
+            for suffix in (".tar.xz", ".tar.bz2"):
+                if sourcefile.endswith(suffix):
+                    return ".orig" + suffix
+        return ".orig.tar.gz"
+
     def deb_source(self, sourcefile=None):
         return self.get("name")
 
@@ -934,21 +2530,17 @@ done < {files}""".format(
         return self.deb_source()+"-"+self.deb_version()
 
     def deb_version(self):
-        if self.cache_version is None:
-            value = self.get("version", "0")
-            self.cache_version = self.expand(value)
-        return self.cache_version
+        value = self.get("version", "0")
+        return self.expand(value)
 
     def deb_revision_with_epoch(self):
         epoch = self.get("epoch", None)
         return self.expand(epoch) + ":" + self.deb_revision() if epoch else self.deb_revision()
 
     def deb_revision(self):
-        if self.cache_revision is None:
-            release = self.get("release", "0")
-            value = self.deb_version()+"-"+release
-            self.cache_revision = self.expand(value)
-        return self.cache_revision
+        release = self.get("release", "0")
+        value = self.deb_version()+"-"+release
+        return self.expand(value)
 
     def debian_dsc(self, nextfile=_nextfile, into=None):
         yield nextfile+"debian/dsc"
@@ -977,108 +2569,40 @@ done < {files}""".format(
             source_orig = self.source_orig_file or source_file
             source_orig_path = os.path.join(into or "", source_orig)
             debian_file_path = os.path.join(into or "", debian_file)
-            source_orig_md5sum = self.md5sum(source_orig_path)
-            debian_file_md5sum = self.md5sum(debian_file_path)
-            if os.path.exists(source_orig_path):
-                source_orig_size = os.path.getsize(source_orig_path)
-                _log.debug("source_orig '%s' size %s",
-                           source_orig_path, source_orig_size)
-            else:
-                source_orig_size = 0
-                _log.info("source_orig '%s' not found", source_orig_path)
-            if os.path.exists(debian_file_path):
-                debian_file_size = os.path.getsize(debian_file_path)
-                _log.debug("debian_file '%s' size %s",
-                           debian_file_path, debian_file_size)
-            else:
-                debian_file_size = 0
-                _log.info("debian_file '%s' not found", debian_file_path)
+            files = [(source_orig, self.dsc_digests(source_orig_path)),
+                     (debian_file, self.dsc_digests(debian_file_path))]
+            yield "+Checksums-Sha1: %s" % ""
+            for name, digests in files:
+                yield "+ %s %i %s" % (digests.sha1, digests.size, name)
+            yield "+Checksums-Sha256: %s" % ""
+            for name, digests in files:
+                yield "+ %s %i %s" % (digests.sha256, digests.size, name)
             yield "+Files: %s" % ""
-            yield "+ %s %i %s" % (source_orig_md5sum, source_orig_size, source_orig)
-            yield "+ %s %s %s" % (debian_file_md5sum, debian_file_size, debian_file)
+            for name, digests in files:
+                yield "+ %s %i %s" % (digests.md5, digests.size, name)
+
+    def dsc_digests(self, filename):
+        """ the FileDigests of a file for the dsc (zeros when it is missing) """
+        if not os.path.isfile(filename):
+            _log.info("'%s' not found", filename)
+            return _missing_digests
+        written = self.written_digests.get(os.path.abspath(filename))
+        if written:
+            stat = os.stat(filename)
+            if (stat.st_size, stat.st_mtime_ns) == written[:2]:
+                _log.debug("'%s' size %s (as written)", filename, stat.st_size)
+                return written[2]
+        digests = file_digests(filename, self.hash_buffer_size)
+        _log.debug("'%s' size %s", filename, digests.size)
+        return digests
 
     def md5sum(self, filename):
-        if not os.path.exists(filename):
-            return "0" * 32
-        with open(filename, mode='rb') as f:
-            d = hashlib.md5()
-            for buf in iter(partial(f.read, 128), b''):
-                d.update(buf)
-        return d.hexdigest()
+        return self.dsc_digests(filename).md5
 
     def group2section(self, group):
-        # there are 3 areas ("main", "contrib", "non-free") with multiple
-        # sections. http://packages.debian.org/unstable/ has a list of all
-        # sections that are currently used. - For Opensuse the current group
-        # list is at http://en.opensuse.org/openSUSE:Package_group_guidelines
-        debian = {
-            "admin": [],
-            "cli-mono": [],
-            "comm": [],
-            "database": ["Productivity/Database"],
-            "debian-installer": [],
-            "debug": ["Development/Tools/Debuggers"],
-            "devel": ["Development/Languages/C and C++"],
-            "doc": ["Documentation"],
-            "editors": [],
-            "electronics": [],
-            "embedded": [],
-            "fonts": [],
-            "games": ["Amusements/Game"],
-            "gnome": ["System/GUI/GNOME"],
-            "gnu-r": [],
-            "gnustep": ["System/GUI/Other"],
-            "graphics": ["Productivity/Graphics"],
-            "hamradio": ["Productivity/Hamradio"],
-            "haskell": [],
-            "httpd": ["Productivity/Networking/Web"],
-            "interpreters": ["Development/Languages/Other"],
-            "java": ["Development/Languages/Java"],
-            "kde": ["System/GUI/KDE"],
-            "kernel": ["System/Kernel"],
-            "libdevel": ["Development/Tool"],
-            "libs": ["Development/Lib", "System/Lib"],
-            "lisp": [],
-            "localization": ["System/Localization", "System/i18n"],
-            "mail": ["Productivity/Networking/Email"],
-            "math": ["Amusements/Teaching/Math", "Productivity/Scientific/Math"],
-            "misc": [],
-            "net": ["Productivity/Networking/System"],
-            "news": ["Productivity/Networking/News"],
-            "ocaml": [],
-            "oldlibs": [],
-            "othersofs": [],
-            "perl": ["Development/Languages/Perl"],
-            "php": [],
-            "python": ["Development/Languages/Python"],
-            "ruby": ["Development/Languages/Ruby"],
-            "science": ["Productivity/Scientific"],
-            "shells": ["System/Shell"],
-            "sound": ["System/Sound"],
-            "tex": ["Productivity/Publishing/TeX"],
-            "text": ["Productivity/Publishing"],
-            "utils": [],
-            "vcs": ["Development/Tools/Version Control"],
-            "video": [],
-            "virtual": [],
-            "web": [],
-            "x11": ["System/X11"],
-            "xfce": ["System/GUI/XFCE"],
-            "zope": [],
-        }
         if isinstance(group, list) and len(group) >= 1:
             group = group[0]
-        for section, group_prefixes in list(debian.items()):
-            for group_prefix in group_prefixes:
-                if group.startswith(group_prefix):
-                    return section
-        # make a guess:
-        if "Lib" in group:
-            return "libs"
-        elif "Network" in group:
-            return "net"
-        else:
-            return "utils"
+        return (self.group_sections or default_group_sections()).section(group)
 
     def deb_description_lines(self, text, prefix="Description:"):
         if isinstance(text, list):
@@ -1117,7 +2641,7 @@ done < {files}""".format(
             section = self.group2section(group)
             yield "+Section: %s" % section
             yield "+Architecture: %s" % self.packages[package].get("architecture", [default_package_architecture])[0]
-            depends = self.packages[package].get("requires", [])
+            depends = list(self.packages[package].get("requires", []))
             if self.get("autoreqprov") == "yes":
                 depends.append("${shlibs:Depends}")
             depends.append("${misc:Depends}")
@@ -1161,10 +2685,11 @@ done < {files}""".format(
             if not isinstance(filesection, list):
                 filesection = [filesection]
             # hack: we put commands with file permission modifications in the post section...
-            postsection = self.packages[package].get("%post")
-            if not postsection:
-                self.packages[package]["%post"] = []
-                postsection = self.packages[package].get("%post")
+            # and start from the parsed %post on each call to stay the same
+            if package not in self._parsed_post:
+                self._parsed_post[package] = self.packages[package].get("%post") or []
+            postsection = list(self._parsed_post[package])
+            self.packages[package]["%post"] = postsection
             # for each package we start again with the default file permissions
             package_file_permissions = '-'
             package_file_user = 'root'
@@ -1288,7 +2813,11 @@ done < {files}""".format(
         for name in self.has_rpm_macros():
             if name.startswith("_"):
                 value = self.get(name)
-                value2 = re.sub(r"[%][{](\w+)[}]", r"${\1}", value)
+                if self.typed[name] == "macrofile":
+                    # may refer to macros that are not in debian/vars
+                    value2 = self.expand(value)
+                else:
+                    value2 = re.sub(r"[%][{](\w+)[}]", r"${\1}", value)
                 yield "+%s=%s" % (name, value2)
         for name in self.has_names():
             if name.startswith("_") and not self.is_default(name):
@@ -1423,78 +2952,100 @@ done < {files}""".format(
         yield "+binary: binary-indep binary-arch"
         yield "+.PHONY: build clean binary-indep binary-arch binary install"
 
+    on_ifelse_if = re.compile(r"\s*if\s+.*$")
+    on_ifelse_then = re.compile(r".*;\s*then\s*$")
+    on_ifelse_else = re.compile(r"\s*else\s*$|.*;\s*else\s*$")
+    on_ifelse_ends = re.compile(r"\s*fi\s*$|.*;\s*fi\s*$")
+    on_script_with = re.compile(r"[%][{][!]?[?]_with[^{}]*[}]")
+    on_script_macro = re.compile(r"[%](?:[{](\w+)[}]|(\w+)\b)")
+
+    def deb_script_value(self, name):
+        """ the replacement of %name in a debian/rules script line """
+        if not self.has(name):
+            return None
+        value = self.get(name)
+        if "$(" in value:
+            # debian_special expands
+            return value
+        elif self.typed[name] == "macrofile":
+            # not in debian/vars
+            return self.expand("%"+name)
+        elif name.startswith("_"):
+            # rpm_macros expands
+            return "${%s}" % name
+        else:
+            return self.expand("%"+name)
+
     def deb_script(self, section):
         script = self.packages["%{name}"].get(section, "")
-        on_ifelse_if = re.compile(r"\s*if\s+.*$")
-        on_ifelse_then = re.compile(r".*;\s*then\s*$")
-        on_ifelse_else = re.compile(r"\s*else\s*$|.*;\s*else\s*$")
-        on_ifelse_ends = re.compile(r"\s*fi\s*$|.*;\s*fi\s*$")
-        ifelse = 0
-        for lines in script:
-            for line in lines.split("\n"):
-                if line.startswith("%setup"):
-                    continue
-                for _ in range(10):
+        values = {}
+
+        def substitute(found):
+            name = found.group(1) or found.group(2)
+            if name not in values:
+                values[name] = self.deb_script_value(name)
+            value = values[name]
+            if value is None:
+                return found.group(0)
+            return value
+
+        def script_lines():
+            for lines in script:
+                for line in lines.split("\n"):
+                    if line.startswith("%setup"):
+                        continue
+                    for _ in range(10):
+                        old = line
+                        line = self.on_script_with.sub("", line)
+                        if old == line:
+                            break
+                    line = line.replace("$RPM_OPT_FLAGS", "$(CFLAGS)")
+                    line = line.replace("%{?jobs:-j%jobs}", "")
                     old = line
-                    line = re.sub("[%][{][?]_with[^{}]*[}]", "", line)
-                    line = re.sub("[%][{][!][?]_with[^{}]*[}]", "", line)
-                    if old == line:
-                        break
-                line = line.replace("$RPM_OPT_FLAGS", "$(CFLAGS)")
-                line = line.replace("%{?jobs:-j%jobs}", "")
-                old = line
-                for name in self.has_names():
-                    if "$(" in self.get(name):
-                        # debian_special expands
-                        value = self.get(name)
-                        line = re.sub(r"[%%][{]%s[}]" % name, value, line)
-                        line = re.sub(r"[%%]%s\b" % name, value, line)
-                    elif name.startswith("_"):
-                        # rpm_macros expands
-                        value = "${%s}" % name
-                        line = re.sub(r"[%%][{]%s[}]" % name, value, line)
-                        line = re.sub(r"[%%]%s\b" % name, value, line)
-                    else:
-                        value = self.expand("%"+name)
-                        line = re.sub(r"[%%][{]%s[}]" % name, value, line)
-                        line = re.sub(r"[%%]%s\b" % name, value, line)
-                line = re.sub(r"[%][{][?]\w+[}]", '', line)
-                if old != line:
-                    _log.debug(" -%s", old)
-                    _log.debug(" +%s", line)
-                found = re.search(r"[%]\w+\b", line)
-                if found:
-                    here = found.group(0)
-                    _log.warning("unexpanded '%s' found:\n %s", here, line)
-                found = re.search(r"[%][{][!?]*\w+[:}]", line)
-                if found:
-                    here = found.group(0)
-                    _log.warning("unexpanded '%s' found:\n %s", here, line)
-                if line.strip() == "rm -rf $(CURDIR)/debian/tmp" and section != "%clean":
-                    _log.warning(
-                        "found rm -rf %%buildroot in section %s (should only be in %%clean)", section)
-                # ifelse handling
-                found_ifelse_if = on_ifelse_if.match(line)
-                found_ifelse_then = on_ifelse_then.match(line)
-                found_ifelse_else = on_ifelse_else.match(line)
-                found_ifelse_ends = on_ifelse_ends.match(line)
-                if found_ifelse_if and not found_ifelse_then:
-                    _log.error(
-                        "'if'-line without '; then' -> not supported\n %s", line)
-                    ifelse += 1
-                elif found_ifelse_then:
-                    line = line + " \\"
-                    ifelse += 1
-                elif found_ifelse_else:
-                    line = line + " \\"
-                    if not ifelse:
-                        _log.error("'else' outside ';then'-block")
-                elif found_ifelse_ends:
-                    ifelse += -1
-                elif ifelse and not line.strip().endswith("\\"):
-                    line += "; \\"
-                if line.strip():
-                    yield line
+                    line = self.on_script_macro.sub(substitute, line)
+                    line = re.sub(r"[%][{][?]\w+[}]", '', line)
+                    if old != line:
+                        _log.debug(" -%s", old)
+                        _log.debug(" +%s", line)
+                    # a macro of a macros file may span multiple lines
+                    for part in line.split("\n"):
+                        yield part
+
+        ifelse = 0
+        for line in script_lines():
+            found = re.search(r"[%]\w+\b", line)
+            if found:
+                here = found.group(0)
+                _log.warning("unexpanded '%s' found:\n %s", here, line)
+            found = re.search(r"[%][{][!?]*\w+[:}]", line)
+            if found:
+                here = found.group(0)
+                _log.warning("unexpanded '%s' found:\n %s", here, line)
+            if line.strip() == "rm -rf $(CURDIR)/debian/tmp" and section != "%clean":
+                _log.warning(
+                    "found rm -rf %%buildroot in section %s (should only be in %%clean)", section)
+            # ifelse handling
+            found_ifelse_if = self.on_ifelse_if.match(line)
+            found_ifelse_then = self.on_ifelse_then.match(line)
+            found_ifelse_else = self.on_ifelse_else.match(line)
+            found_ifelse_ends = self.on_ifelse_ends.match(line)
+            if found_ifelse_if and not found_ifelse_then:
+                _log.error(
+                    "'if'-line without '; then' -> not supported\n %s", line)
+                ifelse += 1
+            elif found_ifelse_then:
+                line = line + " \\"
+                ifelse += 1
+            elif found_ifelse_else:
+                line = line + " \\"
+                if not ifelse:
+                    _log.error("'else' outside ';then'-block")
+            elif found_ifelse_ends:
+                ifelse += -1
+            elif ifelse and not line.strip().endswith("\\"):
+                line += "; \\"
+            if line.strip():
+                yield line
 
     def debian_scripts(self, nextfile=_nextfile):
         preinst = """
@@ -1542,7 +3093,7 @@ done < {files}""".format(
                         for line in script.split("\n"):
                             yield "+"+self.expand(line)
 
-    def debian_patches(self, nextfile=_nextfile):
+    def deb_patch_files(self):
         patches = []
         patch = self.get("patch")
         if patch:
@@ -1551,14 +3102,19 @@ done < {files}""".format(
             patch = self.get("patch%i" % n)
             if patch:
                 patches.append(patch)
+        return patches
+
+    def debian_patches(self, nextfile=_nextfile):
+        patches = self.deb_patch_files()
         if patches:
             yield nextfile+"debian/patches/series"
             for patch in patches:
                 yield "+"+patch
             for patch in patches:
                 yield nextfile+"debian/patches/"+patch
-                for line in open(patch):
-                    yield "+"+line
+                with io.open(patch, 'r', encoding='utf8', errors='replace') as f:
+                    for line in f:
+                        yield "+"+line.rstrip("\n")
         else:
             _log.info("no patches -> no debian/patches/series")
         yield nextfile+"debian/source/format"
@@ -1570,119 +3126,216 @@ done < {files}""".format(
         else:
             return "%s/%s" % (subdir, patch)
 
-    def debian_diff(self):
+    def debian_diff_hunks(self):
+        """ the (patch, count, text) for each generated file where the text
+            has the count "+" lines each followed by a newline """
         for deb in (self.debian_control, self.debian_copyright, self.debian_install,
                     self.debian_changelog, self.debian_patches, self.debian_rules,
                     self.debian_scripts):
-            src = self.deb_src()
-            old = src+".orig"
             patch = None
-            lines = []
+            text = io.StringIO()
+            count = 0
             for line in deb(_nextfile):
                 if isinstance(line, tuple):
                     _log.fatal("?? %s %s", deb, line)
                     line = " ".join(line)
                 if line.startswith(_nextfile):
                     if patch:
-                        yield "--- %s" % self.get_patch_path(old, patch)
-                        yield "+++ %s" % self.get_patch_path(src, patch)
-                        yield "@@ -0,0 +1,%i @@" % (len(lines))
-                        for plus in lines:
-                            yield plus
-                    lines = []
+                        yield patch, count, text.getvalue()
+                    text = io.StringIO()
+                    count = 0
                     patch = line[len(_nextfile):]
                 else:
-                    lines += [line]
+                    text.write(line)
+                    text.write("\n")
+                    count += 1
             # end of deb
-            if lines:
+            if count:
                 if patch:
-                    yield "--- %s" % self.get_patch_path(old, patch)
-                    yield "+++ %s" % self.get_patch_path(src, patch)
-                    yield "@@ -0,0 +1,%i @@" % (len(lines))
-                    for plus in lines:
-                        yield plus
+                    yield patch, count, text.getvalue()
                 else:
                     _log.error("have lines but no patch name: %s", deb)
 
+    def debian_diff_header(self, patch, count):
+        src = self.deb_src()
+        old = src+".orig"
+        yield "--- %s" % self.get_patch_path(old, patch)
+        yield "+++ %s" % self.get_patch_path(src, patch)
+        yield "@@ -0,0 +1,%i @@" % count
+
+    def debian_diff(self):
+        for patch, count, text in self.debian_diff_hunks():
+            for line in self.debian_diff_header(patch, count):
+                yield line
+            for plus in text.split("\n")[:-1]:
+                yield plus
+
+    def debian_inputs(self, filename):
+        """ the fingerprint of what goes into the debian diff/tar """
+        layers = [n for n in range(len(self.var.maps)) if n != self.macrofile_layer]
+        tables = []
+        if self.package_mapping is not None:
+            tables += [file_fingerprint(name) for name in self.package_mapping.files]
+        if self.group_sections is not None:
+            tables += [file_fingerprint(name) for name in self.group_sections.files]
+        if self.apt_index is not None:
+            tables += [file_fingerprint(name, content=False) for name in
+                       self.apt_index.packages_files + self.apt_index.contents_files]
+        return fingerprint(filename, self.manifest.settings, self.macro_files_digest,
+                           [self.var.maps[n] for n in layers],
+                           [file_fingerprint(name) for name in self.spec_files],
+                           [file_fingerprint(name) for name in self.deb_patch_files()],
+                           tables, self.source_format, self.compresslevel, self.gzip_mtime)
+
+    def orig_tar_inputs(self, filename, sourcefile):
+        """ the fingerprint of what goes into the orig tarball """
+        return fingerprint(filename, file_fingerprint(sourcefile, content=False),
+                           self.source_format, self.compresslevel, self.gzip_mtime,
+                           self.gzip_threads, self.orig_placement)
+
+    def unchanged_output(self, filename, filepath, inputs):
+        """ the manifest has the output from the same inputs - its digests
+            are then used for the dsc as if it was just written """
+        if not self.manifest:
+            return False
+        digests = self.manifest.unchanged(filename, filepath, inputs)
+        if not digests:
+            return False
+        stat = os.stat(filepath)
+        self.written_digests[os.path.abspath(filepath)] = (
+            stat.st_size, stat.st_mtime_ns, digests)
+        _log.info("unchanged %s", filepath)
+        return True
+
+    def record_output(self, filename, filepath, inputs):
+        if self.manifest:
+            self.manifest.record(filename, filepath, inputs, self.dsc_digests(filepath))
+
     def write_debian_dsc(self, filename, into=None):
         filepath = os.path.join(into or "", filename)
-        f = open(filepath, "w")
-        try:
-            count = 0
-            for line in self.debian_dsc(into=into):
-                if line.startswith(_nextfile):
-                    continue
-                f.write(line[1:]+"\n")
-                count += 1
-            return "written '%s' with %i lines" % (filepath, count)
-        finally:
-            f.close()
-        return "ERROR", filename
+        text = "".join(line[1:] + "\n" for line in self.debian_dsc(into=into)
+                       if not line.startswith(_nextfile))
+        count = text.count("\n")
+        if self.manifest and os.path.isfile(filepath):
+            with open(filepath) as f:
+                if f.read() == text:
+                    return "unchanged '%s' with %i lines" % (filepath, count)
+        with DigestWriter(filepath) as f:
+            f.write(text.encode('utf-8'))
+        return "written '%s' with %i lines" % (filepath, count)
 
     def write_debian_diff(self, filename, into=None):
         if filename.endswith(".tar.gz") or filename.endswith(".tgz"):
             return self.write_debian_tar(filename, into=into)
         filepath = os.path.join(into or "", filename)
-        if filename.endswith(".gz"):
-            f = gzip.open(filepath, "wb")
-        else:
-            f = open(filepath, "w")
+        inputs = self.manifest and self.debian_inputs(filename)
+        if self.unchanged_output(filename, filepath, inputs):
+            self.debian_file = filename
+            return "unchanged '%s'" % filepath
+        raw = f = self.output_file(filepath)
         try:
+            if filename.endswith(".gz"):
+                f = self.gzip_writer(filepath, raw, threads=1)
             count = 0
-            for line in self.debian_diff():
-                f.write((line + "\n").encode('utf-8'))
-                count += 1
-            f.close()
-            self.debian_file = filename
-            return "written '%s' with %i lines" % (filepath, count)
+            # each file is one chunk and the chunks go out in large writes
+            chunks = []
+            size = 0
+            for patch, lines, text in self.debian_diff_hunks():
+                header = "\n".join(self.debian_diff_header(patch, lines))
+                chunk = (header + "\n" + text).encode('utf-8')
+                chunks.append(chunk)
+                size += len(chunk)
+                count += 3 + lines
+                if size >= self.write_buffer_size:
+                    f.write(b"".join(chunks))
+                    chunks = []
+                    size = 0
+            f.write(b"".join(chunks))
+            if f is not raw:
+                f.close()
+            raw.close()
+        except (IOError, OSError) as e:
+            _log.error("can not write %s: %s", filepath, e)
+            return "ERROR: %s" % filepath
         finally:
-            f.close()
-        return "ERROR: %s" % filepath
+            self.discard_output(f, raw)
+        self.record_output(filename, filepath, inputs)
+        self.debian_file = filename
+        return "written '%s' with %i lines" % (filepath, count)
 
     def write_debian_tar(self, filename, into=None):
         if filename.endswith(".diff") or filename.endswith(".diff.gz"):
             return self.write_debian_diff(filename, into=into)
         filepath = os.path.join(into or "", filename)
-        if filename.endswith(".gz"):
-            tar = tarfile.open(filepath, "w:gz")
-        else:
-            tar = tarfile.open(filepath, "w:")
+        inputs = self.manifest and self.debian_inputs(filename)
+        if self.unchanged_output(filename, filepath, inputs):
+            self.debian_file = filename
+            return "unchanged '%s'" % filepath
+        raw = f = self.output_file(filepath)
         try:
-            state = None
-            name = ""
-            f = None
-            for line in self.debian_diff():
-                if line.startswith("--- "):
-                    if name:
-                        f.flush()
-                        tar.add(f.name, name)
-                        f.close()
-                        name = ""
-                    state = "---"
-                    continue
-                if line.startswith("+++ ") and state == "---":
-                    name = line[len("+++ "):]
-                    f = tempfile.NamedTemporaryFile()
-                    state = "+++"
-                    continue
-                if line.startswith("@@") and state == "+++":
-                    state = "+"
-                    continue
-                if line.startswith("+") and state == "+":
-                    f.write(line[1:] + "\n")
-                    continue
-                _log.warning("unknown %s line:\n %s", state, line)
-            if name:
-                f.flush()
-                tar.add(f.name, name)
-                f.close()
-                name = ""
+            if filename.endswith(".gz"):
+                f = self.gzip_writer(filepath, raw, threads=1)
+            tar = tarfile.open(fileobj=f, mode="w")
+            src = self.deb_src()
+            for patch, count, text in self.debian_diff_hunks():
+                data = io.BytesIO()
+                for line in text.split("\n")[:-1]:
+                    if not line.startswith("+"):
+                        _log.warning("unknown line in %s:\n %s", patch, line)
+                        continue
+                    data.write(line[1:].encode('utf-8'))
+                    data.write(b"\n")
+                info = self.debian_tarinfo(self.get_patch_path(src, patch), data.tell())
+                data.seek(0)
+                tar.addfile(info, data)
             tar.close()
-            self.debian_file = filename
-            return "written '%s'" % filepath
+            if f is not raw:
+                f.close()
+            raw.close()
+        except (IOError, OSError, tarfile.TarError) as e:
+            _log.error("can not write %s: %s", filepath, e)
+            return "ERROR: %s" % filepath
         finally:
-            tar.close()
-        return "ERROR: %s" % filepath
+            self.discard_output(f, raw)
+        self.record_output(filename, filepath, inputs)
+        self.debian_file = filename
+        return "written '%s'" % filepath
+
+    _executable_suffixes = (".sh", "/rules", ".preinst", ".postinst", ".prerm", ".postrm")
+
+    def debian_tarinfo(self, name, size):
+        """ the generated files belong to root and have the gzip_mtime so
+            that the same input gives the same tar """
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o755 if name.endswith(self._executable_suffixes) else 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        info.mtime = self.gzip_mtime
+        return info
+
+    def output_file(self, filepath):
+        """ the DigestWriter for an output that the dsc lists """
+        return DigestWriter(filepath, self.written_digests)
+
+    def discard_output(self, f, raw):
+        """ an output that was not finished is closed (including its gzip
+            writer f) and removed, and its digests are not recorded """
+        if raw.closed:
+            return
+        try:
+            if f is not raw:
+                f.close()
+        except (IOError, OSError):
+            pass
+        raw.discard()
+
+    def gzip_writer(self, filepath, fileobj, threads=None):
+        threads = self.gzip_threads if threads is None else threads
+        if threads == 1:
+            return gzip.GzipFile(filepath, "wb", self.compresslevel, fileobj, self.gzip_mtime)
+        return ParallelGzipWriter(filepath, self.compresslevel, self.gzip_mtime,
+                                  threads, fileobj=fileobj)
 
     def write_debian_orig_tar(self, filename, into=None, path=None):
         sourcefile = self.expand(self.deb_sourcefile())
@@ -1690,32 +3343,43 @@ done < {files}""".format(
             sourcefile = os.path.join(path or "", sourcefile)
             print("----------------- sourcefile " + sourcefile)
         filepath = os.path.join(into or "", filename)
-        if sourcefile.endswith(".tar.gz") or sourcefile.endswith(".tgz"):
-            _log.info("copy %s to %s", sourcefile, filename)
-            shutil.copyfile(sourcefile, filepath)
+        inputs = self.manifest and self.orig_tar_inputs(filename, sourcefile)
+        if self.unchanged_output(filename, filepath, inputs):
             self.source_orig_file = filename
-            return "written '%s'" % filepath
-        elif sourcefile.endswith(".tar.xz"):
-            _log.info("recompress %s to %s", sourcefile, filename)
-            gz = gzip.GzipFile(filepath, "w")
-            gz.write(lzma.open(sourcefile).read())
-            gz.close()
+            return "unchanged '%s'" % filepath
+        compression = tar_compression(sourcefile)
+        if compression == "gz" or (compression and compression == tar_compression(filename)):
+            how = place_file(sourcefile, filepath, self.orig_placement)
+            _log.info("%s %s to %s", how, sourcefile, filename)
+            self.record_output(filename, filepath, inputs)
             self.source_orig_file = filename
             return "written '%s'" % filepath
-        elif sourcefile.endswith(".tar.bz2"):
+        elif sourcefile.endswith(".tar.xz") or sourcefile.endswith(".tar.bz2"):
             _log.info("recompress %s to %s", sourcefile, filename)
-            gz = gzip.GzipFile(filepath, "w")
-            bz = bz2.BZ2File(sourcefile, "r")
-            gz.write(bz.read())
-            gz.close()
-            bz.close()
+            if sourcefile.endswith(".tar.xz"):
+                decompressor = partial(lzma.LZMADecompressor, memlimit=self.recompress_memlimit)
+            else:
+                decompressor = bz2.BZ2Decompressor
+            try:
+                with open(sourcefile, "rb") as f, self.output_file(filepath) as raw:
+                    with self.gzip_writer(filepath, raw) as gz:
+                        for chunk in decompressed_chunks(f, decompressor,
+                                                         self.recompress_buffer_size):
+                            gz.write(chunk)
+            except (lzma.LZMAError, EOFError, IOError, OSError) as e:
+                _log.error("can not recompress %s: %s", sourcefile, e)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                return "ERROR: %s" % filepath
+            self.record_output(filename, filepath, inputs)
             self.source_orig_file = filename
             return "written '%s'" % filepath
         elif sourcefile.endswith(".zip"):
             _log.info("recompress %s to %s", sourcefile, filename)
             # inspired by https://bitbucket.org/ruamel/zip2tar which is much more elaborate...
-            with ZipFile(sourcefile) as zipf:
-                with tarfile.open(filepath, "w:gz") as tarf:
+            with ZipFile(sourcefile) as zipf, self.output_file(filepath) as raw, \
+                    self.gzip_writer(filepath, raw) as gz:
+                with tarfile.open(fileobj=gz, mode="w") as tarf:
                     for zip_info in zipf.infolist():
                         tar_info = tarfile.TarInfo(name=zip_info.filename)
                         tar_info.size = zip_info.file_size
@@ -1738,6 +3402,7 @@ done < {files}""".format(
                             tarinfo=tar_info,
                             fileobj=zipf.open(zip_info.filename)
                         )
+            self.record_output(filename, filepath, inputs)
             self.source_orig_file = filename
             return "written '%s'" % filepath
         else:
@@ -1747,7 +3412,7 @@ done < {files}""".format(
 
 _hint = """NOTE: if neither -f nor -o is given (or any --debian-output) then
 both of these two are generated from the last given *.spec argument file name."""
-_o = OptionParser("%program [options] package.spec",
+_o = OptionParser("%program [options] package.spec (or - for stdin)",
                   description=__doc__, epilog=_hint)
 _o.add_option("-v", "--verbose", action="count",
               help="show more runtime messages", default=0)
@@ -1794,24 +3459,58 @@ _o.add_option("-F", "--debian-diff", action="count",
 _o.add_option("-D", "--debian-dsc", action="count",
               help="output for the debian *.dsc descriptor")
 _o.add_option("-t", "--tar", metavar="FILE",
-              help="create an orig.tar.gz copy of rpm Source0")
+              help="create an orig.tar.gz copy of rpm Source0 (or keep xz/bz2 for format 3.0)")
 _o.add_option("-o", "--dsc", metavar="FILE",
               help="create the debian.dsc descriptor file")
 _o.add_option("-f", "--diff", metavar="FILE", help="""create the debian.diff.gz file
 (depending on the given filename it can also be a debian.tar.gz with the same content)""")
+_o.add_option("--with", metavar="NAME", dest="with_bconds", action="append", default=[],
+              help="enable a %bcond_with build conditional (defines _with_NAME)")
+_o.add_option("--without", metavar="NAME", dest="without_bconds", action="append", default=[],
+              help="disable a %bcond_without build conditional (defines _without_NAME)")
+_o.add_option("--cache-dir", metavar="DIR", dest="cache_dir",
+              help="keep parsed spec models in DIR to skip parsing next time")
+_o.add_option("--shell", action="count",
+              help="run the commands of %(...) and %{lua:...} macros")
+_o.add_option("--shell-budget", metavar="SECONDS", type="float", default=shell_budget,
+              help="stop running %(...) commands after this time in total (%default)")
+_o.add_option("--mapping", metavar="FILE", dest="mapping_files", action="append", default=[],
+              help="load rpm to debian package name mappings (see PackageMapping)")
+_o.add_option("--distro", metavar="NAME", default=package_distro,
+              help="use the [NAME] overrides of the package name mappings")
+_o.add_option("--apt-packages", metavar="FILE", action="append", default=[],
+              help="resolve requires with an apt Packages file (may be compressed)")
+_o.add_option("--apt-contents", metavar="FILE", action="append", default=[],
+              help="resolve file and library requires with an apt Contents-ARCH file")
+_o.add_option("--groups", metavar="FILE", dest="group_files", action="append", default=[],
+              help="load rpm group to debian section mappings (see GroupSections)")
+_o.add_option("--compress-level", metavar="N", type="int", default=compresslevel,
+              help="gzip compression level for the generated files (%default)")
+_o.add_option("--memlimit", metavar="MB", type="int",
+              help="memory limit of the xz decoder when recompressing Source0")
+_o.add_option("--threads", metavar="N", type="int", default=gzip_threads,
+              help="gzip threads when recompressing Source0 (0 for one per cpu)")
+_o.add_option("--placement", metavar=orig_placement, choices=_placements,
+              default=orig_placement, help="how to put a .tar.gz Source0 in place: "
+              + ", ".join(_placements))
+_o.add_option("--incremental", action="count",
+              help="skip the output files whose inputs did not change since the last run")
+_o.add_option("--macros", metavar="FILE:...", dest="macro_files", action="append", default=[],
+              help="load rpm macro files (e.g. /usr/lib/rpm/macros:/usr/lib/rpm/macros.d/macros.*)")
 _o.add_option("--define", metavar="VARIABLE=VALUE", dest="defines",
               help="Specify a variable value in case spec parsing cannot determine it", action="append", default=[])
 _o.add_option("-p", metavar="path", dest="path",
               help="Specify a path where to look for sources")
 _o.add_option("-d", metavar="sources", help="""create and populate a debian sources
-directory. Automatically sets --dsc and --diff, creates an orig.tar.gz and assumes --no-debtransform""")
+directory. Automatically sets --dsc and --diff, creates an orig tarball and assumes --no-debtransform""")
 _o.add_option("--nocheck", action="count", help="skip unit-tests")
 _o.add_option("--nostrip", action="count",
               help="don't strip the files before packaging")
 
 
 def main(args_in):
-    opts, args = _o.parse_args(args_in)
+    # the append options would otherwise add to the shared default lists
+    opts, args = _o.parse_args(args_in, Values(copy.deepcopy(_o.defaults)))
     logging.basicConfig(format="%(levelname)s: %(message)s",
                         level=max(0, logging.INFO - 5 * (opts.verbose - opts.quiet)))
     DONE = logging.INFO + 5
@@ -1842,132 +3541,178 @@ def main(args_in):
             _log.warning("")
             sys.exit(1)  # nothing was done
 
-    if opts.defines:
-        for name, value in [valuepair.split('=', 1) for valuepair in opts.defines]:
-            work.set(name, value, "define")
-
-    for arg in args:
-        work.parse(arg)
-        if ".spec" in arg:
-            spec = arg
-    done = 0
-    if opts.nocheck:
-        work.check = False
-    if opts.nostrip:
-        work.strip = False
-    if opts.importance:
-        work.set_package_importance(opts.importance)
-    if opts.debtransform:
-        work.debtransform = True
-    if opts.no_debtransform:
-        work.debtransform = False
-    if opts.debhelper:
-        work.debhelper_compat = opts.debhelper
-    if opts.urgency:
-        work.urgency = opts.urgency
-    if opts.promote:
-        work.promote = opts.promote
-    if opts.vars:
-        done += opts.vars
-        print("# have %s variables" % len(work.var))
-        for name in sorted(work.has_names()):
-            typed = work.typed[name]
-            print("%%%s %s %s" % (typed, name, work.get(name)))
-    else:
-        _log.log(HINT, "have %s variables (use -1 to show them)" %
-                 len(work.var))
-    if opts.packages:
-        done += opts.packages
-        print("# have %s packages" % len(work.packages))
-        for package in sorted(work.packages):
-            print(" %package -n", package)
-            for name in sorted(work.packages[package]):
-                print("  %s:%s" % (name, work.packages[package][name]))
-    else:
-        _log.log(HINT, "have %s packages (use -2 to show them)" %
-                 len(work.packages))
-    if opts.debian_control:
-        done += opts.debian_control
-        for line in work.debian_control():
-            print(line)
-    if opts.debian_copyright:
-        done += opts.debian_copyright
-        for line in work.debian_copyright():
-            print(line)
-    if opts.debian_install:
-        done += opts.debian_install
-        for line in work.debian_install():
-            print(line)
-    if opts.debian_changelog:
-        done += opts.debian_changelog
-        for line in work.debian_changelog():
-            print(line)
-    if opts.debian_rules:
-        done += opts.debian_rules
-        for line in work.debian_rules():
-            print(line)
-    if opts.debian_patches:
-        done += opts.debian_patches
-        for line in work.debian_patches():
-            print(line)
-    if opts.debian_scripts:
-        done += opts.debian_scripts
-        for line in work.debian_scripts():
-            print(line)
-    if opts.debian_dsc:
-        done += opts.debian_dsc
-        for line in work.debian_dsc():
-            print(line)
-    if opts.debian_diff:
-        done += opts.debian_diff
-        for line in work.debian_diff():
-            print(line)
-    if opts.d:
-        opts.d += "/"
-        if not opts.dsc:
-            opts.dsc = os.path.join(opts.d, os.path.basename(spec) + ".dsc")
-        if not opts.diff:
-            if "3." in work.source_format:
-                opts.diff = "%s_%s.debian.tar.gz" % (
-                    work.deb_source(), work.deb_revision())
+    if opts.cache_dir:
+        work.parse_cache_dir = opts.cache_dir
+    if opts.shell:
+        work.shell = RpmShellRunner(opts.cache_dir)
+        work.shell.budget = opts.shell_budget
+    try:
+        if opts.mapping_files or opts.distro:
+            work.load_package_mapping(package_mapping_files + opts.mapping_files,
+                                      opts.distro, opts.cache_dir)
+        work.compresslevel = opts.compress_level
+        work.gzip_threads = opts.threads
+        work.orig_placement = opts.placement
+        if opts.memlimit:
+            work.recompress_memlimit = opts.memlimit << 20
+        if opts.group_files:
+            work.group_sections = GroupSections(group_mapping_files + opts.group_files)
+        if opts.apt_packages or opts.apt_contents:
+            work.apt_index = AptIndex(opts.apt_packages, opts.apt_contents,
+                                      opts.cache_dir or apt_index_dir).open()
+        if opts.macro_files or rpm_macro_files:
+            work.load_macro_files(opts.macro_files or rpm_macro_files, opts.cache_dir)
+        for name in opts.with_bconds:
+            work.define("_with_" + name, "--with-" + name)
+        for name in opts.without_bconds:
+            work.define("_without_" + name, "--without-" + name)
+        if opts.defines:
+            for name, value in [valuepair.split('=', 1) for valuepair in opts.defines]:
+                work.define(name, value)
+
+        for arg in args:
+            if arg == "-":
+                work.parse(sys.stdin)
             else:
-                opts.diff = "%s_%s.diff.gz" % (
-                    work.deb_source(), work.deb_revision())
-        if not opts.tar:
-            opts.tar = "%s_%s.orig.tar.gz" % (
-                work.deb_source(), work.deb_version())
-        work.debtransform = False
-        if not os.path.isdir(opts.d):
-            os.mkdir(opts.d)
-    elif not done and not opts.diff and not opts.dsc:
-        if work.debtransform:
-            work.debian_file = "debian.tar.gz"
-        elif "3." in work.source_format:
-            work.debian_file = spec+".debian.tar.gz"
+                work.parse(arg)
+            if ".spec" in arg:
+                spec = arg
+        if spec is None:
+            # e.g. read from stdin: the output files are named after the package
+            spec = "%s-%s.spec" % (work.expand(work.deb_source() or "stdin"), work.deb_version())
+        done = 0
+        if opts.nocheck:
+            work.check = False
+        if opts.nostrip:
+            work.strip = False
+        if opts.importance:
+            work.set_package_importance(opts.importance)
+        if opts.debtransform:
+            work.debtransform = True
+        if opts.no_debtransform:
+            work.debtransform = False
+        if opts.debhelper:
+            work.debhelper_compat = opts.debhelper
+        if opts.urgency:
+            work.urgency = opts.urgency
+        if opts.promote:
+            work.promote = opts.promote
+        if opts.vars:
+            done += opts.vars
+            print("# have %s variables" % len(work.var))
+            for name in sorted(work.has_names()):
+                typed = work.typed[name]
+                print("%%%s %s %s" % (typed, name, work.get(name)))
+        else:
+            _log.log(HINT, "have %s variables (use -1 to show them)" %
+                     len(work.var))
+        if opts.packages:
+            done += opts.packages
+            print("# have %s packages" % len(work.packages))
+            for package in sorted(work.packages):
+                print(" %package -n", package)
+                for name in sorted(work.packages[package]):
+                    print("  %s:%s" % (name, work.packages[package][name]))
         else:
-            work.debian_file = spec+".debian.diff.gz"
-        opts.dsc = spec+".dsc"
-        opts.diff = work.debian_file
-        _log.log(HINT, "automatically selecting -o %s -f %s",
-                 opts.dsc, opts.diff)
-    if opts.tar:
-        _log.log(DONE, work.write_debian_orig_tar(
-            opts.tar, into=opts.d, path=opts.path))
-    if opts.diff:
-        _log.log(DONE, work.write_debian_diff(opts.diff, into=opts.d))
-    if opts.dsc:
-        _log.log(DONE, work.write_debian_dsc(opts.dsc, into=opts.d))
-    _log.info("converted %s packages from %s", len(work.packages), args)
-    if opts.extract:
-        cmd = "cd %s && dpkg-source -x %s" % (opts.d or ".", opts.dsc)
-        _log.log(HINT, cmd)
-        output = subprocess.check_output(cmd, shell=True)
-        _log.info("%s", output)
-    if opts.build:
-        cmd = "cd %s && dpkg-source -b %s" % (opts.d or ".", work.deb_src())
-        _log.log(HINT, cmd)
-        output = subprocess.check_output(cmd, shell=True)
-        _log.info("%s", output)
+            _log.log(HINT, "have %s packages (use -2 to show them)" %
+                     len(work.packages))
+        if opts.debian_control:
+            done += opts.debian_control
+            for line in work.debian_control():
+                print(line)
+        if opts.debian_copyright:
+            done += opts.debian_copyright
+            for line in work.debian_copyright():
+                print(line)
+        if opts.debian_install:
+            done += opts.debian_install
+            for line in work.debian_install():
+                print(line)
+        if opts.debian_changelog:
+            done += opts.debian_changelog
+            for line in work.debian_changelog():
+                print(line)
+        if opts.debian_rules:
+            done += opts.debian_rules
+            for line in work.debian_rules():
+                print(line)
+        if opts.debian_patches:
+            done += opts.debian_patches
+            for line in work.debian_patches():
+                print(line)
+        if opts.debian_scripts:
+            done += opts.debian_scripts
+            for line in work.debian_scripts():
+                print(line)
+        if opts.debian_dsc:
+            done += opts.debian_dsc
+            for line in work.debian_dsc():
+                print(line)
+        if opts.debian_diff:
+            done += opts.debian_diff
+            for line in work.debian_diff():
+                print(line)
+        if opts.d:
+            opts.d += "/"
+            if not opts.dsc:
+                opts.dsc = os.path.join(opts.d, os.path.basename(spec) + ".dsc")
+            if not opts.diff:
+                if "3." in work.source_format:
+                    opts.diff = "%s_%s.debian.tar.gz" % (
+                        work.deb_source(), work.deb_revision())
+                else:
+                    opts.diff = "%s_%s.diff.gz" % (
+                        work.deb_source(), work.deb_revision())
+            if not opts.tar:
+                opts.tar = "%s_%s%s" % (
+                    work.deb_source(), work.deb_version(), work.deb_orig_suffix())
+            work.debtransform = False
+            if not os.path.isdir(opts.d):
+                os.mkdir(opts.d)
+        elif not done and not opts.diff and not opts.dsc:
+            if work.debtransform:
+                work.debian_file = "debian.tar.gz"
+            elif "3." in work.source_format:
+                work.debian_file = spec+".debian.tar.gz"
+            else:
+                work.debian_file = spec+".debian.diff.gz"
+            opts.dsc = spec+".dsc"
+            opts.diff = work.debian_file
+            _log.log(HINT, "automatically selecting -o %s -f %s",
+                     opts.dsc, opts.diff)
+        if opts.incremental and (opts.tar or opts.diff or opts.dsc):
+            if spec and "-" not in args:
+                settings = dict((name, value) for name, value in vars(opts).items()
+                                if name not in ("verbose", "quiet"))
+                work.manifest = OutputManifest(os.path.join(
+                    opts.d or "", os.path.basename(spec) + ".manifest"), settings).load()
+            else:
+                _log.warning("--incremental needs a spec file argument")
+        if opts.tar:
+            _log.log(DONE, work.write_debian_orig_tar(
+                opts.tar, into=opts.d, path=opts.path))
+        if opts.diff:
+            _log.log(DONE, work.write_debian_diff(opts.diff, into=opts.d))
+        if opts.dsc:
+            _log.log(DONE, work.write_debian_dsc(opts.dsc, into=opts.d))
+        if work.manifest:
+            work.manifest.save()
+        _log.info("converted %s packages from %s", len(work.packages), args)
+        _log.debug("macro cache: %i hits, %i misses",
+                   work.macro_hits, work.macro_misses)
+        if opts.extract:
+            cmd = "cd %s && dpkg-source -x %s" % (opts.d or ".", opts.dsc)
+            _log.log(HINT, cmd)
+            output = subprocess.check_output(cmd, shell=True)
+            _log.info("%s", output)
+        if opts.build:
+            cmd = "cd %s && dpkg-source -b %s" % (opts.d or ".", work.deb_src())
+            _log.log(HINT, cmd)
+            output = subprocess.check_output(cmd, shell=True)
+            _log.info("%s", output)
+    finally:
+        if work.shell is not None:
+            work.shell.close()
 
 
 if __name__ == "__main__":
@@ -1,20 +1,31 @@
 #!/usr/lib/macq/dev-tools/virtualenv/bin/python3
 # vim: fileencoding=utf-8 ts=4 et sw=4 sts=4
 """ Unit tests """
+import bz2
 from contextlib import redirect_stdout
 import gzip
+import hashlib
 import io
+import lzma
 from pathlib import Path
 import os
 import shutil
+import struct
 import subprocess
+import sys
+import tarfile
 import tempfile
+import time
 import unittest
 from unittest import mock
 from unittest.mock import patch, call
 
 from spec2deb import spec2deb
 
+# the timing and memory measurements are slow and depend on the machine
+benchmark = unittest.skipUnless(os.environ.get("SPEC2DEB_BENCHMARK"),
+                                "set SPEC2DEB_BENCHMARK=1 to run the benchmarks")
+
 
 class TestMacqSpec2Deb(unittest.TestCase):
     """ Test the spec2deb.py command line interface and output """
@@ -47,6 +58,763 @@ class TestMacqSpec2Deb(unittest.TestCase):
                 real_output = f.read().decode()
             self.assertEqual(expected_output, real_output)
 
+    def test_spec_from_stdin(self):
+        into = os.path.join(self.tmp_dir, "stdin")
+        text = ("Name: piped\nVersion: 2\nRelease: 1\nSource: piped-2.tar.gz\n"
+                "%description\npiped\n%files\n/usr/bin/piped\n")
+        Path(self.tmp_dir + "/piped-2.tar.gz").touch()
+        for more in ([], ["--incremental"]):
+            with patch.object(sys, "stdin", io.StringIO(text)), redirect_stdout(io.StringIO()):
+                spec2deb.main(["-", "-d", into, "-p", self.tmp_dir, "-0"] + more)
+            self.assertTrue(os.path.exists(os.path.join(into, "piped-2.spec.dsc")))
+            self.assertTrue(os.path.exists(os.path.join(into, "piped_2-1.diff.gz")))
+
+    def test_spec_events_from_text(self):
+        text = ("Name: pkg\n"
+                "%if 0\n"
+                "Version: 1\n"
+                "%else\n"
+                "Version: 2\n"
+                "%endif\n"
+                "%description\n"
+                "hello\n")
+        scanner = spec2deb.RpmSpecEvents(lambda condition: bool(int(condition)))
+        events = [(event.kind, event.name) for event in scanner.events(text)]
+        self.assertEqual([("section-start", "package"),
+                          ("setting", "setting"),
+                          ("conditional", "new_if"),
+                          ("skipped", "package"),
+                          ("conditional", "new_else"),
+                          ("setting", "setting"),
+                          ("conditional", "end_if"),
+                          ("section-start", "description"),
+                          ("text", "description"),
+                          ("section-end", "description")], events)
+        work = spec2deb.RpmSpecToDebianControl()
+        work.parse(io.StringIO(text))
+        self.assertEqual("2", work.get("version"))
+        self.assertEqual(["hello"], work.packages["%{name}"]["%description"])
+
+    def test_parse_cache_hit_skips_parsing(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        first = spec2deb.RpmSpecToDebianControl()
+        first.parse_cache_dir = cache_dir
+        with redirect_stdout(io.StringIO()):
+            first.parse("test_data/pkg.spec")
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+        second = spec2deb.RpmSpecToDebianControl()
+        second.parse_cache_dir = cache_dir
+        with patch.object(second, "parse_event") as parse_event:
+            second.parse("test_data/pkg.spec")
+        parse_event.assert_not_called()
+        self.assertEqual(first.packages, second.packages)
+        self.assertEqual(first.var, second.var)
+        third = spec2deb.RpmSpecToDebianControl()
+        third.parse_cache_dir = cache_dir
+        third.set("some_variable_that_does_not_exist", "1", "define")
+        with redirect_stdout(io.StringIO()):
+            third.parse("test_data/pkg.spec")
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+    def test_parse_cache_warm_hit_is_a_cold_parse(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache-state")
+        spec = os.path.join(self.tmp_dir, "state.spec")
+        with open(spec, "w") as f:
+            f.write("Name: state\nVersion: %(echo 1.0)\nRequires: foo-devel\n"
+                    "%package extra\nSummary: extra\n")
+        def parse(cache, shell=False, mapping=None):
+            work = spec2deb.RpmSpecToDebianControl()
+            work.parse_cache_dir = cache
+            if shell:
+                work.shell = spec2deb.RpmShellRunner()
+            if mapping:
+                work.load_package_mapping([mapping])
+            with redirect_stdout(io.StringIO()):
+                work.parse(spec)
+            if work.shell:
+                work.shell.close()
+            return work.var.maps[work.spec_layer], work.packages, work.package, work.get("version")
+        cold = parse(None)
+        self.assertEqual(cold, parse(cache_dir))
+        self.assertEqual(cold, parse(cache_dir))
+        self.assertEqual("%{name}-extra", cold[2])
+        self.assertEqual("1.0", parse(cache_dir, shell=True)[3])
+        self.assertEqual(parse(None, shell=True), parse(cache_dir, shell=True))
+        mapping = os.path.join(self.tmp_dir, "state-mapping.txt")
+        with open(mapping, "w") as f:
+            f.write("foo-devel  libfoo9-dev\n")
+        self.assertEqual(parse(None, mapping=mapping), parse(cache_dir, mapping=mapping))
+        self.assertEqual(3, len(os.listdir(cache_dir)))
+
+    def test_expand_macros(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        work.set("name", "pkg", "define")
+        work.set("a", "x%{b}", "define")
+        work.set("b", "%a", "define")
+        self.assertEqual("/usr/lib/pkg", work.expand("%{_libdir}/%name"))
+        self.assertEqual("-j %%name", work.expand("%{?name:-j %%name}"))
+        self.assertEqual("0", work.expand("0%{?undefined}"))
+        self.assertEqual("yes", work.expand("%{!?undefined:%{?name:yes}}"))
+        with self.assertLogs(spec2deb._log, "ERROR"):
+            self.assertEqual("x%a", work.expand("%{a}"))
+
+    def test_expand_memo_invalidated_by_set(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual("/usr/lib", work.expand("%{_libdir}"))
+        misses = work.macro_misses
+        self.assertEqual("/usr/lib", work.expand("%{_libdir}"))
+        self.assertEqual(misses, work.macro_misses)
+        self.assertEqual(1, work.macro_hits)
+        work.set("_lib", "lib64", "define")
+        self.assertEqual("/usr/lib64", work.expand("%{_libdir}"))
+        work.set("_prefix", "/opt", "define")
+        self.assertEqual("/opt/lib64", work.expand("%{_libdir}"))
+
+    def test_macro_layers_are_not_shared(self):
+        first = spec2deb.RpmSpecToDebianControl()
+        first.define("_prefix", "/opt")
+        first.set("_libdir", "%{_prefix}/lib64", "default")
+        first.set("buildroot", "/tmp/x", "global")
+        self.assertEqual("/opt/lib64", first.expand("%{_libdir}"))
+        self.assertEqual("${CURDIR}/debian/tmp", first.get("buildroot"))
+        self.assertIn("_libdir", first.rpm_macros)
+        second = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual("/usr/lib", second.expand("%{_libdir}"))
+        self.assertEqual(second.has_names().count("_libdir"), 1)
+        self.assertNotEqual(first.rpm_macros, second.rpm_macros)
+        first.set("_prefix", "/srv", "global")
+        self.assertEqual("/srv/lib64", first.expand("%{_libdir}"))
+        first.set("zzz", "1", "global")
+        first.set("aaa", "1", "global")
+        # the defaults in their order, then the later layers as they came
+        names = first.has_names()
+        self.assertEqual(second.has_names(), names[:len(second.has_names())])
+        self.assertEqual(["zzz", "aaa"], names[-2:])
+
+    def test_macro_files_index(self):
+        macros_dir = os.path.join(self.tmp_dir, "macros.d")
+        os.makedirs(macros_dir)
+        with open(os.path.join(macros_dir, "macros.a"), "w") as f:
+            f.write("# comment\n"
+                    "%_prefix /opt\n"
+                    "%_unitdir %{_prefix}/lib/systemd/system\n"
+                    "%cmake(n) \\\n"
+                    "  cmake \\\n"
+                    "  -DPREFIX=%{_prefix}\n")
+        with open(os.path.join(macros_dir, "macros.b"), "w") as f:
+            f.write("%_unitdir /lib/systemd/system\n")
+        cache_dir = os.path.join(self.tmp_dir, "macros-cache")
+        pattern = macros_dir + "/macros.*"
+        work = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual(2, work.load_macro_files([pattern], cache_dir).reads)
+        self.assertEqual("/lib/systemd/system", work.expand("%_unitdir"))
+        self.assertEqual("/opt/lib", work.expand("%{_libdir}"))
+        self.assertEqual("cmake \\\n  -DPREFIX=/opt", work.expand("%cmake"))
+        work.parse(io.StringIO("Name: pkg\n%build\n%cmake\n"))
+        self.assertEqual(["cmake \\", "  -DPREFIX=/opt"], list(work.deb_script("%build")))
+        again = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual(0, again.load_macro_files([pattern], cache_dir).reads)
+        self.assertEqual("/lib/systemd/system", again.expand("%_unitdir"))
+        with open(os.path.join(macros_dir, "macros.b"), "w") as f:
+            f.write("%_unitdir /usr/lib/systemd/system\n")
+        again = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual(1, again.load_macro_files([pattern], cache_dir).reads)
+        self.assertEqual("/usr/lib/systemd/system", again.expand("%_unitdir"))
+        index_file = again.load_macro_files([pattern], cache_dir).index_file()
+        self.assertTrue(index_file.endswith(".json"))
+        with open(index_file, "wb") as f:
+            f.write(b"\x80\x04garbage")
+        again = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual(2, again.load_macro_files([pattern], cache_dir).reads)
+        self.assertEqual("/usr/lib/systemd/system", again.expand("%_unitdir"))
+
+    def test_shell_commands(self):
+        text = ("Name: pkg\n"
+                "%define one %(sleep 0.5; echo 1)\n"
+                "%define two %(sleep 0.5; echo %{name}-2)\n"
+                "Version: %one.%{two}\n")
+        cache_dir = os.path.join(self.tmp_dir, "shell-cache")
+        work = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual("%(echo 1)", work.expand("%(echo 1)"))
+        work.shell = spec2deb.RpmShellRunner(cache_dir)
+        pending = []
+        def output(argv, output=work.shell.output):
+            pending.append(len(work.shell.futures))
+            return output(argv)
+        with patch.object(work.shell, "output", side_effect=output):
+            work.parse(io.StringIO(text))
+        # both commands were started before the first output was needed
+        self.assertEqual(2, pending[0])
+        self.assertEqual("1.pkg-2", work.get("version"))
+        self.assertEqual("1", work.expand("%(echo $HOME | grep -c spec2deb-)"))
+        self.assertEqual(3, work.shell.runs)
+        again = spec2deb.RpmSpecToDebianControl()
+        again.shell = spec2deb.RpmShellRunner(cache_dir)
+        again.parse(io.StringIO(text))
+        self.assertEqual("1.pkg-2", again.get("version"))
+        self.assertEqual(0, again.shell.runs)
+        again.shell.budget = 0.5
+        started = time.monotonic()
+        with self.assertLogs(spec2deb._log, "ERROR"):
+            self.assertEqual("%(sleep 5)", again.expand("%(sleep 5)"))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(1, len(again.shell.procs))
+        again.shell.close()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(set(), again.shell.procs)
+        skipped = spec2deb.RpmSpecToDebianControl()
+        skipped.shell = spec2deb.RpmShellRunner()
+        skipped.parse(io.StringIO("Name: pkg\n%if 0\n%if %(echo 1)\nVersion: 1\n"
+                                  "%else\nVersion: 2\n%endif\n%endif\n"))
+        skipped.shell.close()
+        self.assertEqual(0, skipped.shell.runs)
+        self.assertIsNone(skipped.get("version", None))
+
+    @benchmark
+    def test_benchmark_shell_commands_run_concurrently(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        work.shell = spec2deb.RpmShellRunner()
+        started = time.monotonic()
+        work.parse(io.StringIO("Name: pkg\n"
+                               "%define one %(sleep 0.5; echo 1)\n"
+                               "%define two %(sleep 0.5; echo 2)\n"
+                               "Version: %one.%{two}\n"))
+        self.assertLess(time.monotonic() - started, 0.9)
+        work.shell.close()
+
+    def test_package_mapping(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual("zlib1g-dev", work.deb_package_name("zlib-devel"))
+        self.assertEqual("foo-dev", work.deb_package_name("foo-devel"))
+        self.assertEqual("libfoo-bar-perl", work.deb_package_name("perl(Foo::Bar)"))
+        self.assertEqual("python3-requests", work.deb_package_name("python3dist(requests)"))
+        mapping_file = os.path.join(self.tmp_dir, "mapping.txt")
+        with open(mapping_file, "w") as f:
+            f.write("# rpm  deb\n"
+                    "python3-*-devel  python3-*-dev\n"
+                    "foo-devel  libfoo1-dev\n"
+                    "[ubuntu]\n"
+                    "foo-devel  libfoo2-dev\n")
+        cache_dir = os.path.join(self.tmp_dir, "mapping-cache")
+        work.load_package_mapping([mapping_file], "ubuntu", cache_dir)
+        self.assertEqual("libfoo2-dev", work.deb_package_name("foo-devel"))
+        self.assertEqual("python3-x-dev", work.deb_package_name("python3-x-devel"))
+        self.assertEqual("bar-dev", work.deb_package_name("bar-devel"))
+        again = spec2deb.RpmSpecToDebianControl()
+        with patch.object(spec2deb.PackageMapping, "scan") as scan:
+            again.load_package_mapping([mapping_file], "ubuntu", cache_dir)
+        scan.assert_not_called()
+        self.assertEqual("libfoo2-dev", again.deb_package_name("foo-devel"))
+        again.load_package_mapping([mapping_file])
+        self.assertEqual("libfoo1-dev", again.deb_package_name("foo-devel"))
+        broken_file = os.path.join(self.tmp_dir, "broken.txt")
+        with open(broken_file, "w") as f:
+            f.write("# rpm  deb\n"
+                    "baz-devel\n"
+                    "qux-devel  libqux-dev\n")
+        with self.assertLogs(spec2deb._log, "WARNING") as logs:
+            again.load_package_mapping([broken_file])
+        self.assertEqual(["%s:2: no debian name for 'baz-devel'" % broken_file],
+                         [record.getMessage() for record in logs.records])
+        self.assertEqual("libqux-dev", again.deb_package_name("qux-devel"))
+
+    def test_package_mapping_of_parsed_requires(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        work.parse(io.StringIO("Name: deps\nVersion: 1\nRelease: 1\n"
+                               "BuildRequires: perl(Foo::Bar) pkgconfig(glib-2.0)\n"
+                               "BuildRequires: python3dist(requests) >= 2.0, zlib-devel\n"
+                               "%description\ndeps\n%files\n/usr/bin/deps\n"))
+        self.assertIn("+Build-Depends: debhelper (>= 5), libfoo-bar-perl, libglib-2.0-dev, "
+                      "python3-requests (>= 2.0), zlib1g-dev", list(work.debian_control()))
+
+    def test_apt_index_resolves_requires(self):
+        packages = os.path.join(self.tmp_dir, "Packages")
+        with open(packages, "w") as f:
+            f.write("Package: perl\nVersion: 5.36.0-7\nProvides: perl5\n\n"
+                    "Package: libfoo1\nVersion: 1.0-1\n\n")
+        contents = os.path.join(self.tmp_dir, "Contents-amd64.gz")
+        with gzip.open(contents, "wt") as f:
+            f.write("usr/bin/perl    perl/perl\n"
+                    "usr/lib/x86_64-linux-gnu/libfoo.so.1    libs/libfoo1,libs/libfoo1-dbg\n"
+                    "usr/share/doc/a b/README    doc/with-space\n")
+        index_dir = os.path.join(self.tmp_dir, "apt-index")
+        index = spec2deb.AptIndex([packages], [contents], index_dir).open()
+        self.assertEqual("perl", index.resolve("/usr/bin/perl"))
+        self.assertEqual("perl", index.resolve("/bin/perl"))
+        self.assertEqual("libfoo1", index.resolve("libfoo.so.1()(64bit)"))
+        self.assertEqual("with-space", index.get("f:usr/share/doc/a b/README"))
+        self.assertIsNone(index.resolve("/usr/bin/python"))
+        self.assertTrue(index.has_package("perl5"))
+        self.assertFalse(index.has_package("python"))
+        work = spec2deb.RpmSpecToDebianControl()
+        work.parse(io.StringIO("Name: deps\nVersion: 1\nRelease: 1\n"
+                               "Requires: /usr/bin/perl >= 5.10, libfoo.so.1()(64bit)\n"
+                               "%description\ndeps\n%files\n/usr/bin/deps\n"))
+        self.assertEqual("/usr/bin/perl (>= 5.10)", work.deb_requires("/usr/bin/perl >= 5.10"))
+        with patch.object(spec2deb.AptIndex, "records") as records:
+            work.apt_index = spec2deb.AptIndex([packages], [contents], index_dir).open()
+        records.assert_not_called()
+        self.assertIn("+Depends: perl (>= 5.10), libfoo1, ${shlibs:Depends}, ${misc:Depends}",
+                      list(work.debian_control()))
+        self.assertEqual("perl (>= 5.10)", work.deb_requires("/usr/bin/perl >= 5.10"))
+        self.assertEqual("libfoo1", work.deb_requires("libfoo.so.1()(64bit)"))
+        self.assertEqual("zlib1g-dev", work.deb_requires("zlib-devel"))
+        other_file = spec2deb.AptIndex([packages], [], index_dir).open().index_file()
+        self.assertEqual(2, len(os.listdir(index_dir)))
+        with open(packages, "a") as f:
+            f.write("Package: python3\nVersion: 3.11.2-1\n\n")
+        index = spec2deb.AptIndex([packages], [contents], index_dir).open()
+        self.assertTrue(index.has_package("python3"))
+        self.assertEqual(sorted([os.path.basename(index.index_file()),
+                                 os.path.basename(other_file)]),
+                         sorted(os.listdir(index_dir)))
+
+    def test_relations_are_parsed_once(self):
+        relation = spec2deb.RpmRelation.parse("foo-devel => 1.0")
+        self.assertIs(relation, spec2deb.RpmRelation.parse("foo-devel => 1.0"))
+        self.assertEqual(("foo-devel", "=>", "1.0"), relation)
+        self.assertEqual(">=", relation.deb_operator())
+        work = spec2deb.RpmSpecToDebianControl()
+        with redirect_stdout(io.StringIO()):
+            work.parse("test_data/pkg.spec")
+        with patch.object(work, "deb_require_name", wraps=work.deb_require_name) as name:
+            control = list(work.debian_control())
+            calls = name.call_count
+            self.assertEqual(control, list(work.debian_control()))
+            self.assertEqual(calls, name.call_count)
+        depends = work.deb_build_depends()
+        self.assertEqual(len(depends), len(set(depends)))
+        self.assertIn("package3-dev (>> 1.2.3-0)", depends)
+
+    def test_group_sections(self):
+        work = spec2deb.RpmSpecToDebianControl()
+        self.assertEqual("tex", work.group2section("Productivity/Publishing/TeX/Base"))
+        self.assertEqual("text", work.group2section(["Productivity/Publishing/PDF"]))
+        self.assertEqual("vcs", work.group2section("Development/Tools/Version Control"))
+        self.assertEqual("libs", work.group2section("Applications/Libraries"))
+        groups_file = os.path.join(self.tmp_dir, "groups.txt")
+        with open(groups_file, "w") as f:
+            f.write("# fedora\n"
+                    "admin Applications/System\n"
+                    "games\n"
+                    "devel Development/Languages/C and C++/Tools\n")
+        with self.assertLogs(spec2deb._log, "WARNING") as logs:
+            work.group_sections = spec2deb.GroupSections([groups_file])
+        self.assertEqual(["%s:3: no group prefix for 'games'" % groups_file],
+                         [record.getMessage() for record in logs.records])
+        self.assertEqual("admin", work.group2section("Applications/System"))
+        self.assertEqual("devel", work.group2section("Development/Languages/C and C++/Tools"))
+        self.assertEqual("java", work.group2section("Development/Languages/Java"))
+
+    def test_debian_diff_writer(self):
+        def converter():
+            work = spec2deb.RpmSpecToDebianControl()
+            with redirect_stdout(io.StringIO()):
+                work.parse("test_data/pkg.spec")
+            work.write_buffer_size = 100
+            return work
+        expected = "".join(line + "\n" for line in converter().debian_diff())
+        converter().write_debian_diff("first.diff.gz", self.tmp_dir)
+        converter().write_debian_diff("plain.diff", self.tmp_dir)
+        with gzip.open(os.path.join(self.tmp_dir, "first.diff.gz"), "rb") as f:
+            self.assertEqual(expected, f.read().decode("utf-8"))
+        with open(os.path.join(self.tmp_dir, "plain.diff"), "rb") as f:
+            self.assertEqual(expected, f.read().decode("utf-8"))
+        work = converter()
+        work.compresslevel = 1
+        work.write_debian_diff("second.diff.gz", self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, "second.diff.gz"), "rb") as f:
+            second = f.read()
+        # a rewrite an hour later has the same bytes
+        later = time.time() + 3600
+        os.utime(os.path.join(self.tmp_dir, "second.diff.gz"), (later - 7200, later - 7200))
+        work = converter()
+        work.compresslevel = 1
+        with patch("time.time", return_value=later):
+            work.write_debian_diff("second.diff.gz", self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, "second.diff.gz"), "rb") as f:
+            self.assertEqual(second, f.read())
+        self.assertGreater(os.stat(os.path.join(self.tmp_dir, "second.diff.gz")).st_mtime,
+                           later - 7200)
+        work = converter()
+        work.set("patch9", os.path.join(self.tmp_dir, "missing.patch"), "setting")
+        for name in ("broken.diff", "broken.diff.gz"):
+            with self.assertLogs(spec2deb._log, "ERROR"):
+                self.assertEqual("ERROR: " + os.path.join(self.tmp_dir, name),
+                                 work.write_debian_diff(name, self.tmp_dir))
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, name)))
+        self.assertEqual({}, work.written_digests)
+
+    def test_debian_tar_in_memory(self):
+        def write_tar():
+            work = spec2deb.RpmSpecToDebianControl()
+            with redirect_stdout(io.StringIO()):
+                work.parse("test_data/pkg.spec")
+            work.set_source_format("3.0")
+            hunks = list(work.debian_diff_hunks())
+            with patch.object(tempfile, "NamedTemporaryFile") as temporary:
+                work.write_debian_tar("pkg.debian.tar.gz", self.tmp_dir)
+            temporary.assert_not_called()
+            with open(os.path.join(self.tmp_dir, "pkg.debian.tar.gz"), "rb") as f:
+                return hunks, f.read()
+        hunks, data = write_tar()
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            members = tar.getmembers()
+            self.assertEqual([patch for patch, _, _ in hunks], [m.name for m in members])
+            rules = tar.getmember("debian/rules")
+            self.assertEqual((0o755, 0, 0), (rules.mode, rules.uid, rules.gid))
+            self.assertEqual(0o644, tar.getmember("debian/control").mode)
+            control = [text for patch, _, text in hunks if patch == "debian/control"][0]
+            self.assertEqual(control.replace("+", "", 1).replace("\n+", "\n"),
+                             tar.extractfile("debian/control").read().decode("utf-8"))
+        self.assertEqual(data, write_tar()[1])
+        work = spec2deb.RpmSpecToDebianControl()
+        with redirect_stdout(io.StringIO()):
+            work.parse("test_data/pkg.spec")
+        work.set("patch9", os.path.join(self.tmp_dir, "missing.patch"), "setting")
+        with self.assertLogs(spec2deb._log, "ERROR"):
+            self.assertEqual("ERROR: " + os.path.join(self.tmp_dir, "broken.debian.tar"),
+                             work.write_debian_tar("broken.debian.tar", self.tmp_dir))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "broken.debian.tar")))
+        self.assertEqual({}, work.written_digests)
+        patch_file = os.path.join(self.tmp_dir, "fix.patch")
+        patch_text = "--- a/x\n+++ b/x\n@@ -1 +1 @@\n-old\n+new\n"
+        with open(patch_file, "w") as f:
+            f.write(patch_text)
+        work.set("patch9", patch_file, "setting")
+        self.assertIn("+-old", list(work.debian_patches()))
+        with patch.object(spec2deb._log, "warning") as warning:
+            work.write_debian_tar("patched.debian.tar", self.tmp_dir)
+        self.assertEqual([], [call for call in warning.call_args_list
+                              if call[0][0].startswith("unknown line")])
+        with tarfile.open(os.path.join(self.tmp_dir, "patched.debian.tar")) as tar:
+            member = [m for m in tar.getmembers() if m.name.endswith("/fix.patch")][0]
+            self.assertEqual(patch_text, tar.extractfile(member).read().decode("utf-8"))
+
+    def test_recompress_in_bounded_chunks(self):
+        data = lzma.compress(bytes(1 << 20)) + lzma.compress(b"x" * 5000)
+        reads = []
+        class Source(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+        chunks = list(spec2deb.decompressed_chunks(Source(data), lzma.LZMADecompressor, 1000))
+        self.assertEqual((1 << 20) + 5000, sum(len(chunk) for chunk in chunks))
+        self.assertEqual(1000, max(len(chunk) for chunk in chunks))
+        self.assertEqual({1000}, set(reads))
+
+    def test_recompress_orig_tar_streaming(self):
+        block = os.urandom(1 << 16)
+        with lzma.open(os.path.join(self.tmp_dir, "multi-1.tar.xz"), "wb") as f:
+            f.write(block)
+        with open(os.path.join(self.tmp_dir, "multi-1.tar.xz"), "ab") as f:
+            f.write(lzma.compress(block * 2))
+        with bz2.open(os.path.join(self.tmp_dir, "multi-1.tar.bz2"), "wb") as f:
+            f.write(block * 3)
+        for source in ("multi-1.tar.xz", "multi-1.tar.bz2"):
+            work = spec2deb.RpmSpecToDebianControl()
+            work.set("source", source, "setting")
+            work.recompress_buffer_size = 1000
+            with redirect_stdout(io.StringIO()):
+                work.write_debian_orig_tar("multi.orig.tar.gz", self.tmp_dir, self.tmp_dir)
+            with gzip.open(os.path.join(self.tmp_dir, "multi.orig.tar.gz")) as f:
+                self.assertEqual(block * 3, f.read())
+        work.set("source", "multi-1.tar.xz", "setting")
+        work.recompress_memlimit = 1000
+        with redirect_stdout(io.StringIO()), self.assertLogs(spec2deb._log, "ERROR"):
+            work.write_debian_orig_tar("multi.orig.tar.gz", self.tmp_dir, self.tmp_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "multi.orig.tar.gz")))
+
+    def test_native_orig_tar_for_quilt(self):
+        with lzma.open(os.path.join(self.tmp_dir, "native-1.tar.xz"), "wb") as f:
+            f.write(os.urandom(1000))
+        work = spec2deb.RpmSpecToDebianControl()
+        work.set("name", "native", "setting")
+        work.set("source", "native-1.tar.xz", "setting")
+        self.assertEqual(".orig.tar.gz", work.deb_orig_suffix())
+        work.set_source_format("3.0")
+        self.assertEqual(".orig.tar.xz", work.deb_orig_suffix())
+        with redirect_stdout(io.StringIO()):
+            work.write_debian_orig_tar("native_1.orig.tar.xz", self.tmp_dir, self.tmp_dir)
+        self.assertTrue(spec2deb.same_content(os.path.join(self.tmp_dir, "native-1.tar.xz"),
+                                              os.path.join(self.tmp_dir, "native_1.orig.tar.xz")))
+        files = [line for line in work.debian_dsc(into=self.tmp_dir)
+                 if line.endswith(".orig.tar.xz")]
+        self.assertEqual(3, len(files))
+        self.assertTrue(files[-1].endswith(" %i native_1.orig.tar.xz" % os.path.getsize(
+            os.path.join(self.tmp_dir, "native-1.tar.xz"))))
+
+    def test_dsc_checksums(self):
+        data = os.urandom(3 << 20) + b"end"
+        with open(os.path.join(self.tmp_dir, "sums_1.orig.tar.gz"), "wb") as f:
+            f.write(data)
+        digests = spec2deb.file_digests(os.path.join(self.tmp_dir, "sums_1.orig.tar.gz"), 1000)
+        self.assertEqual(len(data), digests.size)
+        self.assertEqual(hashlib.md5(data).hexdigest(), digests.md5)
+        self.assertEqual(hashlib.sha1(data).hexdigest(), digests.sha1)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), digests.sha256)
+        work = spec2deb.RpmSpecToDebianControl()
+        work.set("name", "sums", "setting")
+        work.set("source", "sums-1.tar.gz", "setting")
+        work.source_orig_file = "sums_1.orig.tar.gz"
+        work.debian_file = "sums_1.diff.gz"
+        with patch("builtins.open", wraps=open) as opened:
+            dsc = list(work.debian_dsc(into=self.tmp_dir))
+        self.assertEqual(1, opened.call_count)
+        self.assertEqual(["+Checksums-Sha1: ",
+                          "+ %s %i sums_1.orig.tar.gz" % (digests.sha1, len(data)),
+                          "+ %s 0 sums_1.diff.gz" % ("0" * 40),
+                          "+Checksums-Sha256: ",
+                          "+ %s %i sums_1.orig.tar.gz" % (digests.sha256, len(data)),
+                          "+ %s 0 sums_1.diff.gz" % ("0" * 64),
+                          "+Files: ",
+                          "+ %s %i sums_1.orig.tar.gz" % (digests.md5, len(data)),
+                          "+ %s 0 sums_1.diff.gz" % ("0" * 32)], dsc[-9:])
+
+    def test_dsc_uses_digests_from_writing(self):
+        with bz2.open(os.path.join(self.tmp_dir, "tee-1.tar.bz2"), "wb") as f:
+            f.write(os.urandom(100000))
+        work = spec2deb.RpmSpecToDebianControl()
+        work.parse(io.StringIO("Name: tee\nVersion: 1\nRelease: 1\nSource: tee-1.tar.bz2\n"
+                               "%description\ntee\n%files\n/usr/bin/tee\n"))
+        work.gzip_threads = 2
+        with redirect_stdout(io.StringIO()):
+            work.write_debian_orig_tar("tee_1.orig.tar.gz", self.tmp_dir, self.tmp_dir)
+            work.write_debian_diff("tee_1.diff.gz", self.tmp_dir)
+        with patch.object(spec2deb, "file_digests") as digests:
+            dsc = list(work.debian_dsc(into=self.tmp_dir))
+        digests.assert_not_called()
+        for name in ("tee_1.orig.tar.gz", "tee_1.diff.gz"):
+            expected = spec2deb.file_digests(os.path.join(self.tmp_dir, name))
+            self.assertIn("+ %s %i %s" % (expected.sha256, expected.size, name), dsc)
+            self.assertIn("+ %s %i %s" % (expected.md5, expected.size, name), dsc)
+        with open(os.path.join(self.tmp_dir, "tee_1.diff.gz"), "ab") as f:
+            f.write(b"changed")
+        expected = spec2deb.file_digests(os.path.join(self.tmp_dir, "tee_1.diff.gz"))
+        self.assertIn("+ %s %i tee_1.diff.gz" % (expected.sha1, expected.size),
+                      list(work.debian_dsc(into=self.tmp_dir)))
+
+    def test_incremental_conversion(self):
+        into = os.path.join(self.tmp_dir, "incremental")
+        spec = os.path.join(self.tmp_dir, "inc.spec")
+        with open(spec, "w") as f:
+            f.write("Name: inc\nVersion: 1\nRelease: 1\nSource: inc-1.tar.bz2\n"
+                    "%description\ninc\n%files\n%attr(0755,root,root) /usr/bin/inc\n")
+        with bz2.open(os.path.join(self.tmp_dir, "inc-1.tar.bz2"), "wb") as f:
+            f.write(os.urandom(10000))
+        args = [spec, "-d", into, "-p", self.tmp_dir, "--incremental", "-0"]
+        outputs = ["inc_1.orig.tar.gz", "inc_1-1.diff.gz", "inc.spec.dsc"]
+        def convert(*more):
+            with redirect_stdout(io.StringIO()):
+                spec2deb.main(args + list(more))
+            return [os.stat(os.path.join(into, name)).st_mtime_ns for name in outputs]
+        written = convert()
+        with open(os.path.join(into, "inc.spec.dsc"), "rb") as f:
+            dsc = f.read()
+        with patch.object(spec2deb, "file_digests") as digests, \
+                patch.object(spec2deb.RpmSpecToDebianControl, "debian_diff_hunks") as hunks:
+            self.assertEqual(written, convert())
+        digests.assert_not_called()
+        hunks.assert_not_called()
+        time.sleep(0.01)
+        changed = convert("--define", "extra=1")
+        self.assertEqual(written[0], changed[0])
+        self.assertNotEqual(written[1], changed[1])
+        self.assertEqual(written[2], changed[2])
+        with open(os.path.join(into, "inc.spec.dsc"), "rb") as f:
+            self.assertEqual(dsc, f.read())
+        shutil.rmtree(into)
+        convert()
+        with open(os.path.join(into, "inc.spec.dsc"), "rb") as f:
+            self.assertEqual(dsc, f.read())
+        mapping = os.path.join(self.tmp_dir, "inc-mapping.txt")
+        with open(mapping, "w") as f:
+            f.write("inc  inc-one\n")
+        mapped = convert("--mapping", mapping)
+        self.assertEqual(mapped, convert("--mapping", mapping))
+        with open(mapping, "w") as f:
+            f.write("inc  inc-two\n")
+        remapped = convert("--mapping", mapping)
+        self.assertEqual(mapped[0], remapped[0])
+        self.assertNotEqual(mapped[1], remapped[1])
+        with gzip.open(os.path.join(into, "inc_1-1.diff.gz"), "rt") as f:
+            self.assertIn("+Package: inc-two\n", f.read())
+
+    @benchmark
+    def test_benchmark_recompress_memory_is_flat(self):
+        script = ("import resource, sys\n"
+                  "from spec2deb import spec2deb\n"
+                  "work = spec2deb.RpmSpecToDebianControl()\n"
+                  "work.set('source', sys.argv[1], 'setting')\n"
+                  "work.compresslevel = 1\n"
+                  "work.write_debian_orig_tar('big.orig.tar.gz', sys.argv[2], sys.argv[2])\n"
+                  "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n")
+        def peak_rss(megabytes):
+            source = "big-%i.tar.xz" % megabytes
+            block = os.urandom(1 << 16)
+            with lzma.open(os.path.join(self.tmp_dir, source), "wb", preset=1) as f:
+                for _ in range(megabytes * 16):
+                    f.write(block)
+            output = subprocess.check_output([sys.executable, "-c", script, source, self.tmp_dir])
+            return int(output.split()[-1])  # KB
+        small = peak_rss(8)
+        large = peak_rss(64)
+        # reading it all at once would add the 56MB difference
+        self.assertLess(large - small, 16 * 1024)
+
+    def test_parallel_gzip_members(self):
+        data = os.urandom(1 << 16) * 20 + b"tail"
+        filename = os.path.join(self.tmp_dir, "parallel.gz")
+        with spec2deb.ParallelGzipWriter(filename, 6, 0, 3, block_size=100000) as gz:
+            for n in range(0, len(data), 30000):
+                gz.write(data[n:n + 30000])
+            self.assertEqual(len(data), gz.tell())
+        self.assertEqual(data, subprocess.check_output(["gzip", "-dc", filename]))
+        with spec2deb.ParallelGzipWriter(filename, threads=2):
+            pass
+        with gzip.open(filename) as f:
+            self.assertEqual(b"", f.read())
+        with patch.object(spec2deb.concurrent.futures, "ThreadPoolExecutor") as pool:
+            with self.assertRaises(OSError):
+                spec2deb.ParallelGzipWriter(os.path.join(self.tmp_dir, "missing", "x.gz"))
+        pool.assert_not_called()
+        member = spec2deb.gzip_member(data, 1, 1234)
+        self.assertEqual(b"\x1f\x8b\x08\x00" + struct.pack("<I", 1234) + b"\x04\xff",
+                         member[:10])
+        self.assertEqual(data, gzip.decompress(member))
+        if sys.version_info >= (3, 8):
+            self.assertEqual(gzip.compress(data, 9, mtime=1234),
+                             spec2deb.gzip_member(data, 9, 1234))
+
+    def test_orig_tar_placement(self):
+        source = os.path.join(self.tmp_dir, "placed-1.0.tar.gz")
+        target = os.path.join(self.tmp_dir, "placed_1.0.orig.tar.gz")
+        data = os.urandom(1 << 16)
+        with open(source, "wb") as f:
+            f.write(data)
+        for placement in spec2deb._placements:
+            if os.path.exists(target):
+                os.remove(target)
+            how = spec2deb.place_file(source, target, placement)
+            self.assertIn(how, [placement, "hardlink", "reflink", "copy_file_range", "copy"])
+            self.assertEqual(data, Path(target).read_bytes())
+        self.assertEqual("identical", spec2deb.place_file(source, target))
+        self.assertEqual("copy", spec2deb.place_file(source, target, "copy"))
+        self.assertFalse(os.path.samefile(source, target))
+        with open(target, "wb") as f:
+            f.write(data[:-1] + b"x")
+        self.assertEqual("hardlink", spec2deb.place_file(source, target, "hardlink"))
+        self.assertTrue(os.path.samefile(source, target))
+        # an output written over the hardlink leaves the source alone
+        with spec2deb.DigestWriter(target) as f:
+            f.write(b"rewritten")
+        self.assertEqual(data, Path(source).read_bytes())
+        self.assertEqual(b"rewritten", Path(target).read_bytes())
+        with self.assertRaises(ValueError):
+            with spec2deb.DigestWriter(target) as f:
+                f.write(b"broken")
+                raise ValueError("stop")
+        self.assertEqual(b"rewritten", Path(target).read_bytes())
+        self.assertEqual("hardlink", spec2deb.place_file(source, target, "hardlink"))
+        self.assertEqual("identical", spec2deb.place_file(source, source))
+        os.remove(target)
+        with patch.object(os, "link", side_effect=OSError("cross-device link")):
+            self.assertEqual("copy", spec2deb.place_file(source, target, "hardlink"))
+        self.assertEqual(data, Path(target).read_bytes())
+        self.assertEqual(["placed_1.0.orig.tar.gz"],
+                         [name for name in os.listdir(self.tmp_dir) if name.startswith("placed_")])
+
+    @benchmark
+    @unittest.skipUnless((os.cpu_count() or 1) >= 2, "needs more than one cpu")
+    def test_benchmark_parallel_gzip_scales(self):
+        data = os.urandom(1 << 20) * 64
+        def elapsed(threads):
+            started = time.perf_counter()
+            with spec2deb.ParallelGzipWriter(os.path.join(self.tmp_dir, "scale.gz"),
+                                             threads=threads, block_size=1 << 20) as gz:
+                gz.write(data)
+            return time.perf_counter() - started
+        self.assertLess(elapsed(2), elapsed(1) * 0.8)
+
+    def test_if_conditions(self):
+        evaluate = spec2deb.RpmExpression.evaluate
+        self.assertEqual(1, evaluate('07 >= 7 && "a" != "b"'))
+        self.assertEqual(1, evaluate('v"1.0~rc1" < v"1.0" || 0'))
+        self.assertEqual(1, evaluate("1.2.10 > 1.2.9"))
+        self.assertEqual(3, evaluate("0 ? 2 : 3"))
+        self.assertRaises(ValueError, evaluate, "__import__('os')")
+        self.assertEqual(-1, spec2deb.rpmvercmp("1.0", "1.0.1"))
+        self.assertEqual(1, spec2deb.rpmvercmp("1.0^git1", "1.0"))
+        text = ("%bcond_without docs\n"
+                "%bcond_with tests\n"
+                "Name: pkg\n"
+                "%if 0%{?rhel} >= 7\n"
+                "Release: el\n"
+                "%elif %{with docs} && %{without tests}\n"
+                "Release: docs\n"
+                "%else\n"
+                "Release: other\n"
+                "%endif\n")
+        work = spec2deb.RpmSpecToDebianControl()
+        work.parse(io.StringIO(text))
+        self.assertEqual("docs", work.get("release"))
+        work = spec2deb.RpmSpecToDebianControl()
+        work.set("_without_docs", "1", "define")
+        work.parse(io.StringIO(text))
+        self.assertEqual("other", work.get("release"))
+        work = spec2deb.RpmSpecToDebianControl()
+        work.set("rhel", "7", "define")
+        work.parse(io.StringIO(text))
+        self.assertEqual("el", work.get("release"))
+
+    def test_spec_tokens_for_define_sets(self):
+        tokens = spec2deb.RpmSpecTokens.read("test_data/pkg.spec")
+        self.assertEqual(['0%{?some_variable_that_does_not_exist}',
+                          '"%{?_vendor}" == "bogus"'], tokens.conditions())
+        for defines in ({}, {"some_variable_that_does_not_exist": "1"},
+                        {"_vendor": "bogus"}):
+            parsed = spec2deb.RpmSpecToDebianControl()
+            evaluated = spec2deb.RpmSpecToDebianControl()
+            for name, value in defines.items():
+                parsed.set(name, value, "define")
+                evaluated.set(name, value, "define")
+            with redirect_stdout(io.StringIO()):
+                parsed.parse("test_data/pkg.spec")
+                with patch.object(spec2deb.RpmSpecEvents, "classify") as classify:
+                    evaluated.parse(tokens)
+                classify.assert_not_called()
+            self.assertEqual(parsed.packages, evaluated.packages)
+            self.assertEqual(parsed.var, evaluated.var)
+
+    def test_section_text_is_joined_once(self):
+        text = "Name: big\nVersion: 1\n%files\n" + "".join(
+            "/usr/share/big/file%i\n" % n for n in range(1000)) + "%changelog\n"
+        work = spec2deb.RpmSpecToDebianControl()
+        with patch.object(spec2deb.RpmSpecToDebianControl, "section_text", autospec=True,
+                          side_effect=spec2deb.RpmSpecToDebianControl.section_text) as joined:
+            work.parse(io.StringIO(text))
+        self.assertEqual(2, joined.call_count)  # %files and %changelog
+        self.assertEqual(1000, work.packages["%{name}"]["%files"][0].count("\n") + 1)
+
+    @benchmark
+    def test_benchmark_large_files_section_is_linear(self):
+        def parse_time(count):
+            text = "Name: big\nVersion: 1\n%files\n" + "".join(
+                "/usr/share/big/file%i\n" % n for n in range(count))
+            best = None
+            for _ in range(2):
+                work = spec2deb.RpmSpecToDebianControl()
+                started = time.perf_counter()
+                work.parse(io.StringIO(text))
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            self.assertEqual(count, work.packages["%{name}"]["%files"][0].count("\n") + 1)
+            return best
+        small = parse_time(50000)
+        large = parse_time(200000)
+        # 4x the lines: linear is ~4x the time, quadratic would be ~16x
+        self.assertLess(large, small * 8)
+
 
 if __name__ == '__main__':
     unittest.main()